@@ -2,10 +2,11 @@
 import os
 import re
 import logging
+from contextlib import contextmanager, asynccontextmanager
 from dotenv import load_dotenv
 import psycopg
 from psycopg.rows import dict_row
-from psycopg_pool import ConnectionPool
+from psycopg_pool import ConnectionPool, AsyncConnectionPool
 
 # Загрузить .env до чтения переменных
 load_dotenv(override=True)
@@ -29,25 +30,43 @@ DSN = os.getenv("POSTGRES_DSN")
 if not DSN:
     raise RuntimeError("POSTGRES_DSN is not set. Put it into .env or export it before starting the bot.")
 
-# Создаём пул соединений с dict_row для совместимости с sqlite
+# Синхронный пул с dict_row для совместимости с sqlite; открывается при первом
+# обращении через DB (обработчики бота работают через adb и его не открывают)
 pool = ConnectionPool(
     DSN,
     min_size=1,
     max_size=10,
     timeout=30,  # ожидание свободного коннекта из пула
-    kwargs={"row_factory": dict_row}
+    kwargs={"row_factory": dict_row},
+    open=False
 )
 
-# Диагностика при старте
+# Асинхронный пул для обработчиков бота (открывается в post_init приложения)
+async_pool = AsyncConnectionPool(
+    DSN,
+    min_size=int(os.getenv("DB_POOL_MIN_SIZE", "1")),
+    max_size=int(os.getenv("DB_POOL_MAX_SIZE", "10")),
+    timeout=30,
+    kwargs={"row_factory": dict_row},
+    open=False
+)
+
+# Диагностика при старте (проверка соединения - в adb.open())
 print(f"[db_pg] Using DSN: {_mask_dsn(DSN)}")
-try:
-    with pool.connection() as _c:
-        with _c.cursor() as _cur:
-            _cur.execute("SELECT 1")
-    print("[db_pg] DB ping OK")
-except Exception as e:
-    print("[db_pg] DB ping FAILED:", e)
-    raise
+
+
+def _sync_pool() -> ConnectionPool:
+    """Синхронный пул, открытый при первом использовании"""
+    if pool.closed:
+        pool.open(wait=True)
+        print("[db_pg] Sync pool opened")
+    return pool
+
+
+def _is_select_like(sql: str) -> bool:
+    """Запрос возвращает строки (SELECT/CTE/RETURNING)"""
+    sql_norm = sql.lstrip().lower()
+    return sql_norm.startswith(("select", "with")) or " returning " in sql_norm
 
 
 class CursorProxy:
@@ -95,6 +114,73 @@ class ExecResult:
         return []
 
 
+class FetchedResult:
+    """Уже прочитанные строки запроса (для асинхронного API)"""
+    def __init__(self, rows: list, rowcount: int):
+        self._rows = rows
+        self.rowcount = rowcount
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+
+class TxResult:
+    """
+    Результат запроса внутри DB.transaction().
+    Запросы копятся в pipeline; при чтении результата pipeline синхронизируется.
+    """
+    def __init__(self, cur: psycopg.Cursor, pipeline):
+        self._cur = cur
+        self._pipeline = pipeline
+
+    def _wait(self):
+        self._pipeline.sync()
+
+    def fetchone(self):
+        self._wait()
+        return self._cur.fetchone() if self._cur.description is not None else None
+
+    def fetchall(self):
+        self._wait()
+        return self._cur.fetchall() if self._cur.description is not None else []
+
+    @property
+    def rowcount(self) -> int:
+        self._wait()
+        return self._cur.rowcount
+
+
+class Transaction:
+    """
+    Единица работы: одно соединение из пула, одна транзакция, запросы
+    отправляются пакетом (pipeline mode). Интерфейс - как у DB.
+    """
+    def __init__(self, conn: psycopg.Connection, pipeline):
+        self._conn = conn
+        self._pipeline = pipeline
+
+    def execute(self, sql: str, params=()):
+        cur = self._conn.cursor()
+        cur.execute(sql, params)
+        return TxResult(cur, self._pipeline)
+
+    def executemany(self, sql: str, seq_of_params):
+        cur = self._conn.cursor()
+        cur.executemany(sql, seq_of_params)
+
+    def commit(self):
+        """Коммит - при выходе из блока transaction()"""
+        pass
+
+    def rollback(self):
+        """Откат - при исключении внутри блока transaction()"""
+        pass
+
+
 class DB:
     """
     Обёртка для работы с PostgreSQL через пул соединений.
@@ -107,12 +193,9 @@ class DB:
         - Для SELECT/CTE/RETURNING возвращает CursorProxy с методами fetchone()/fetchall()
         - Для INSERT/UPDATE/DELETE без RETURNING возвращает ExecResult с rowcount
         """
-        sql_norm = sql.lstrip().lower()
-        is_select_like = sql_norm.startswith(("select", "with")) or " returning " in sql_norm
-
-        if is_select_like:
+        if _is_select_like(sql):
             # SELECT-подобный запрос
-            conn = pool.getconn()
+            conn = _sync_pool().getconn()
             cur = conn.cursor()
             try:
                 cur.execute(sql, params)
@@ -127,7 +210,7 @@ class DB:
             return CursorProxy(conn, cur)
         else:
             # DML запрос (INSERT/UPDATE/DELETE без RETURNING)
-            with pool.connection() as conn:
+            with _sync_pool().connection() as conn:
                 try:
                     with conn.cursor() as cur:
                         cur.execute(sql, params)
@@ -146,7 +229,7 @@ class DB:
         """
         Выполнение батча запросов без возврата результатов.
         """
-        with pool.connection() as conn:
+        with _sync_pool().connection() as conn:
             try:
                 with conn.cursor() as cur:
                     cur.executemany(sql, seq_of_params)
@@ -159,6 +242,27 @@ class DB:
                 logging.exception("SQL error on executemany:\nSQL: %s", _shorten(sql))
                 raise
 
+    @contextmanager
+    def transaction(self):
+        """
+        Несколько запросов в одной транзакции на одном соединении:
+
+            with db.transaction() as tx:
+                tx.execute("INSERT ...", (...))
+                row = tx.execute("SELECT ...", (...)).fetchone()
+
+        Запросы без чтения результата уходят в БД одним пакетом,
+        коммит - при выходе из блока, при исключении - откат.
+        """
+        with _sync_pool().connection() as conn:
+            try:
+                with conn.pipeline() as pipeline:
+                    with conn.transaction():
+                        yield Transaction(conn, pipeline)
+            except Exception:
+                logging.exception("Error in DB transaction")
+                raise
+
     def commit(self):
         """
         Совместимость с sqlite API.
@@ -166,6 +270,123 @@ class DB:
         """
         pass
 
+    def rollback(self):
+        """
+        Совместимость с sqlite API.
+        Отдельные запросы откатываются сами, для нескольких - db.transaction().
+        """
+        pass
+
 
 # Создаём глобальный экземпляр
-db = DB()
\ No newline at end of file
+db = DB()
+
+class AsyncTxResult:
+    """
+    Результат команды без выборки внутри AsyncDB.transaction().
+    Команда остаётся в pipeline; число строк читается с синхронизацией:
+
+        affected = await res.fetch_rowcount()
+    """
+    def __init__(self, cur: psycopg.AsyncCursor, pipeline):
+        self._cur = cur
+        self._pipeline = pipeline
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+    async def fetch_rowcount(self) -> int:
+        await self._pipeline.sync()
+        return self._cur.rowcount
+
+
+class AsyncTransaction:
+    """
+    Асинхронная единица работы (pipeline mode, одна транзакция).
+    Запросы без результата копятся в pipeline (число строк - await res.fetch_rowcount());
+    запрос, возвращающий строки, отправляет накопленное и сразу читает ответ.
+    """
+    def __init__(self, conn: psycopg.AsyncConnection, pipeline):
+        self._conn = conn
+        self._pipeline = pipeline
+
+    async def execute(self, sql: str, params=()):
+        cur = self._conn.cursor()
+        await cur.execute(sql, params)
+        if not _is_select_like(sql):
+            return AsyncTxResult(cur, self._pipeline)
+        await self._pipeline.sync()
+        return FetchedResult(await cur.fetchall(), cur.rowcount)
+
+
+class AsyncDB:
+    """
+    Асинхронный аналог DB на AsyncConnectionPool для обработчиков бота:
+
+        row = (await adb.execute("SELECT ...", (...))).fetchone()
+
+    Строки читаются сразу, соединение возвращается в пул до возврата результата.
+    """
+
+    async def open(self):
+        await async_pool.open(wait=True)
+        print("[db_pg] Async pool opened")
+        try:
+            async with async_pool.connection() as conn:
+                await conn.execute("SELECT 1")
+            print("[db_pg] DB ping OK")
+        except Exception as e:
+            print("[db_pg] DB ping FAILED:", e)
+            raise
+
+    async def close(self):
+        await async_pool.close()
+
+    async def execute(self, sql: str, params=()):
+        async with async_pool.connection() as conn:
+            try:
+                cur = await conn.execute(sql, params)
+                rows = await cur.fetchall() if cur.description is not None else []
+                result = FetchedResult(rows, cur.rowcount)
+                await conn.commit()
+                return result
+            except Exception:
+                try:
+                    await conn.rollback()
+                except Exception:
+                    pass
+                logging.exception("SQL error (async):\nSQL: %s\nPARAMS: %r", _shorten(sql), params)
+                raise
+
+    async def executemany(self, sql: str, seq_of_params):
+        async with async_pool.connection() as conn:
+            try:
+                async with conn.cursor() as cur:
+                    await cur.executemany(sql, seq_of_params)
+                await conn.commit()
+            except Exception:
+                try:
+                    await conn.rollback()
+                except Exception:
+                    pass
+                logging.exception("SQL error on executemany (async):\nSQL: %s", _shorten(sql))
+                raise
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Асинхронный аналог DB.transaction()"""
+        async with async_pool.connection() as conn:
+            try:
+                async with conn.pipeline() as pipeline:
+                    async with conn.transaction():
+                        yield AsyncTransaction(conn, pipeline)
+            except Exception:
+                logging.exception("Error in async DB transaction")
+                raise
+
+
+# Асинхронный экземпляр
+adb = AsyncDB()
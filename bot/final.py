@@ -31,126 +31,148 @@ PAYMENT_TOKEN = os.getenv("PAYMENT_PROVIDER_TOKEN", "")
 TRIAL_HOURS = int(os.getenv("TRIAL_HOURS", "24"))
 WELCOME_IMAGE = os.getenv("WELCOME_IMAGE_URL", "")
 ADMIN_USERNAME = (os.getenv("ADMIN_USERNAME", "") or "").lower()
+# Сколько апдейтов обрабатывается одновременно (1 - строго по очереди).
+# Апдейты одного чата всегда обрабатываются по порядку.
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "8"))
+BOT_MAX_PENDING_UPDATES = int(os.getenv("BOT_MAX_PENDING_UPDATES", "0")) or None
 
 if not BOT_TOKEN:
     raise RuntimeError("TELEGRAM_BOT_TOKEN is required in .env")
 
 # Подключение к базе данных
-from db_pg import db
+from db_pg import adb
+from update_processor import PerChatUpdateProcessor
 
 # ============================================
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
 # ============================================
 
-def save_user(user_id: int, username: str = None):
-    """Сохранить/обновить пользователя в БД"""
+async def save_user(user_id: int, username: str = None):
+    """
+    Сохранить/обновить пользователя в БД (одной транзакцией).
+    Возвращает {"free_until", "ref_code"} пользователя или None при ошибке.
+    """
     try:
         uname = (username or "").lower().lstrip("@")
-        db.execute(
-            "INSERT INTO subscriptions (user_id, username) VALUES (%s, %s) "
-            "ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username",
-            (user_id, uname)
-        )
-        db.execute(
-            "INSERT INTO credits (user_id, labs_credits) VALUES (%s, 0) "
-            "ON CONFLICT (user_id) DO NOTHING",
-            (user_id,)
-        )
-        db.execute(
-            "INSERT INTO referrals (user_id, ref_code, invited_count) VALUES (%s, %s, 0) "
-            "ON CONFLICT (user_id) DO NOTHING",
-            (user_id, secrets.token_urlsafe(6))
-        )
-        db.commit()
+        async with adb.transaction() as tx:
+            await tx.execute(
+                "INSERT INTO subscriptions (user_id, username) VALUES (%s, %s) "
+                "ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username",
+                (user_id, uname)
+            )
+            await tx.execute(
+                "INSERT INTO credits (user_id, labs_credits) VALUES (%s, 0) "
+                "ON CONFLICT (user_id) DO NOTHING",
+                (user_id,)
+            )
+            await tx.execute(
+                "INSERT INTO referrals (user_id, ref_code, invited_count) VALUES (%s, %s, 0) "
+                "ON CONFLICT (user_id) DO NOTHING",
+                (user_id, secrets.token_urlsafe(6))
+            )
+            return (await tx.execute(
+                "SELECT s.free_until, r.ref_code FROM subscriptions s "
+                "LEFT JOIN referrals r ON r.user_id = s.user_id "
+                "WHERE s.user_id = %s",
+                (user_id,)
+            )).fetchone()
     except Exception as e:
         logger.exception(f"Error saving user {user_id}: {e}")
-        db.rollback()
+        return None
 
 
-def activate_trial(user_id: int, hours: int) -> datetime:
+async def activate_trial(user_id: int, hours: int, tx=adb) -> datetime:
     """Активировать пробный период"""
-    try:
-        db.execute(
-            "INSERT INTO subscriptions (user_id) VALUES (%s) "
-            "ON CONFLICT (user_id) DO NOTHING",
-            (user_id,)
-        )
-        until = datetime.now(timezone.utc) + timedelta(hours=hours)
-        db.execute(
-            "UPDATE subscriptions SET free_until = %s WHERE user_id = %s",
-            (until, user_id)
-        )
-        db.commit()
-        return until
-    except Exception as e:
-        logger.exception(f"Error activating trial for {user_id}: {e}")
-        db.rollback()
-        raise
+    until = datetime.now(timezone.utc) + timedelta(hours=hours)
+    await tx.execute(
+        "INSERT INTO subscriptions (user_id, free_until) VALUES (%s, %s) "
+        "ON CONFLICT (user_id) DO UPDATE SET free_until = EXCLUDED.free_until",
+        (user_id, until)
+    )
+    return until
 
 
-def get_ref_code(user_id: int) -> str:
+async def get_ref_code(user_id: int) -> str:
     """Получить реферальный код пользователя"""
-    row = db.execute(
+    row = (await adb.execute(
         "SELECT ref_code FROM referrals WHERE user_id = %s",
         (user_id,)
-    ).fetchone()
+    )).fetchone()
     if row and row["ref_code"]:
         return row["ref_code"]
     
     code = secrets.token_urlsafe(6)
     try:
-        db.execute(
+        await adb.execute(
             "INSERT INTO referrals (user_id, ref_code, invited_count) VALUES (%s, %s, 0) "
             "ON CONFLICT (user_id) DO UPDATE SET ref_code = EXCLUDED.ref_code",
             (user_id, code)
         )
-        db.commit()
     except Exception as e:
         logger.exception(f"Error generating ref code for {user_id}: {e}")
-        db.rollback()
     return code
 
 
-def activate_sub(user_id: int, days: int) -> datetime:
-    """Активировать подписку"""
-    try:
-        db.execute(
-            "INSERT INTO subscriptions (user_id) VALUES (%s) "
-            "ON CONFLICT (user_id) DO NOTHING",
-            (user_id,)
-        )
-        row = db.execute(
-            "SELECT expires_at FROM subscriptions WHERE user_id = %s",
-            (user_id,)
-        ).fetchone()
-        
-        now = datetime.now(timezone.utc)
-        base = now
-        
-        if row and row["expires_at"]:
-            try:
-                existing = row["expires_at"]
-                if isinstance(existing, str):
-                    existing = datetime.fromisoformat(existing)
-                if hasattr(existing, 'tzinfo') and existing.tzinfo is None:
-                    existing = existing.replace(tzinfo=timezone.utc)
-                if existing > now:
-                    base = existing
-            except Exception as e:
-                logger.warning(f"Error parsing existing date: {e}")
-                base = now
+async def activate_sub(user_id: int, days: int, tx=adb) -> datetime:
+    """
+    Активировать подписку: продлить от текущей даты окончания,
+    если она ещё не прошла, иначе - от текущего момента
+    """
+    row = (await tx.execute(
+        """
+        INSERT INTO subscriptions (user_id, expires_at)
+        VALUES (%(user_id)s, now() + make_interval(days => %(days)s))
+        ON CONFLICT (user_id) DO UPDATE SET
+            expires_at = GREATEST(COALESCE(subscriptions.expires_at, now()), now())
+                         + make_interval(days => %(days)s)
+        RETURNING expires_at
+        """,
+        {"user_id": user_id, "days": days}
+    )).fetchone()
+    return row["expires_at"]
+
+
+async def add_labs_credits(user_id: int, qty: int, tx=adb):
+    """Начислить кредиты на анализы"""
+    await tx.execute(
+        "INSERT INTO credits (user_id, labs_credits) VALUES (%s, %s) "
+        "ON CONFLICT (user_id) DO UPDATE SET labs_credits = credits.labs_credits + EXCLUDED.labs_credits",
+        (user_id, qty)
+    )
+
+
+async def apply_referral(code: str, invited_id: int):
+    """
+    Засчитать приглашение по реферальному коду (одной транзакцией).
+    Возвращает id пригласившего, если бонус начислен.
+    """
+    async with adb.transaction() as tx:
+        row = (await tx.execute(
+            """
+            INSERT INTO referral_activations (inviter_id, invited_id)
+            SELECT r.user_id, %(invited_id)s
+            FROM referrals r
+            WHERE r.ref_code = %(code)s
+              AND r.user_id <> %(invited_id)s
+              AND NOT EXISTS (
+                  SELECT 1 FROM referral_activations WHERE invited_id = %(invited_id)s
+              )
+            ON CONFLICT DO NOTHING
+            RETURNING inviter_id
+            """,
+            {"code": code, "invited_id": invited_id}
+        )).fetchone()
+        if not row:
+            return None
         
-        new_exp = base + timedelta(days=days)
-        db.execute(
-            "UPDATE subscriptions SET expires_at = %s WHERE user_id = %s",
-            (new_exp, user_id)
+        inviter_id = row["inviter_id"]
+        await tx.execute(
+            "UPDATE referrals SET invited_count = COALESCE(invited_count, 0) + 1 "
+            "WHERE user_id = %s",
+            (inviter_id,)
         )
-        db.commit()
-        return new_exp
-    except Exception as e:
-        logger.exception(f"Error activating subscription for {user_id}: {e}")
-        db.rollback()
-        raise
+        await activate_sub(inviter_id, 7, tx)  # 7 дней бонус
+        return inviter_id
 
 
 # ============================================
@@ -165,68 +187,45 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     3. Показывает приветствие с кнопкой Mini App
     """
     user = update.effective_user
-    save_user(user.id, user.username)
+    saved = await save_user(user.id, user.username)
     
     # Обработка реферальной ссылки
     if context.args:
         code = (context.args[0] or "").strip()
         if code:
-            row = db.execute(
-                "SELECT user_id FROM referrals WHERE ref_code = %s",
-                (code,)
-            ).fetchone()
-            inviter_id = row["user_id"] if row else None
-            
-            if inviter_id and inviter_id != user.id:
-                # Проверяем что реферал еще не активирован
-                act = db.execute(
-                    "SELECT 1 FROM referral_activations WHERE invited_id = %s",
-                    (user.id,)
-                ).fetchone()
-                
-                if not act:
+            try:
+                inviter_id = await apply_referral(code, user.id)
+                if inviter_id:
                     try:
-                        db.execute(
-                            "INSERT INTO referral_activations (inviter_id, invited_id) "
-                            "VALUES (%s, %s) ON CONFLICT DO NOTHING",
-                            (inviter_id, user.id)
-                        )
-                        db.execute(
-                            "UPDATE referrals SET invited_count = COALESCE(invited_count, 0) + 1 "
-                            "WHERE user_id = %s",
-                            (inviter_id,)
+                        await context.bot.send_message(
+                            inviter_id,
+                            "🎉 Вам начислено +7 дней за приглашённого друга!"
                         )
-                        activate_sub(inviter_id, 7)  # 7 дней бонус
-                        db.commit()
-                        
-                        try:
-                            await context.bot.send_message(
-                                inviter_id,
-                                "🎉 Вам начислено +7 дней за приглашённого друга!"
-                            )
-                        except Exception:
-                            pass
-                    except Exception as e:
-                        logger.exception(f"Error processing referral: {e}")
-                        db.rollback()
+                    except Exception:
+                        pass
+            except Exception as e:
+                logger.exception(f"Error processing referral: {e}")
     
     # Активация триала (только для новых пользователей)
+    if saved is None:
+        # Сохранение не удалось - перечитываем: ошибка не значит, что пользователь новый
+        try:
+            saved = (await adb.execute(
+                "SELECT free_until FROM subscriptions WHERE user_id = %s",
+                (user.id,)
+            )).fetchone()
+        except Exception as e:
+            logger.exception(f"Error reading subscription for {user.id}: {e}")
     is_admin = (user.username or "").lower() == ADMIN_USERNAME and ADMIN_USERNAME
-    if not is_admin:
-        row = db.execute(
-            "SELECT free_until FROM subscriptions WHERE user_id = %s",
-            (user.id,)
-        ).fetchone()
-        
-        if row is None or not row.get("free_until"):
-            until = activate_trial(user.id, TRIAL_HOURS)
-            try:
-                await update.message.reply_text(
-                    f"🎁 Пробный доступ активирован на {TRIAL_HOURS} часов!\n"
-                    f"До: {until.strftime('%d.%m.%Y %H:%M UTC')}"
-                )
-            except Exception:
-                pass
+    if not is_admin and saved is not None and not saved.get("free_until"):
+        until = await activate_trial(user.id, TRIAL_HOURS)
+        try:
+            await update.message.reply_text(
+                f"🎁 Пробный доступ активирован на {TRIAL_HOURS} часов!\n"
+                f"До: {until.strftime('%d.%m.%Y %H:%M UTC')}"
+            )
+        except Exception:
+            pass
     
     # Установка кнопки Mini App
     async def setup_menu_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -262,7 +261,7 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error setting menu button: {e}")
     
     # Генерация реферальной ссылки
-    ref_code = get_ref_code(user.id)
+    ref_code = saved["ref_code"] if saved and saved.get("ref_code") else await get_ref_code(user.id)
     bot_me = await context.bot.get_me()
     ref_link = f"t.me/{bot_me.username}?start={ref_code}"
     
@@ -339,10 +338,10 @@ async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     # Проверка дубликата
     if provider_charge_id:
-        dup = db.execute(
+        dup = (await adb.execute(
             "SELECT 1 FROM payments WHERE provider_charge_id = %s",
             (provider_charge_id,)
-        ).fetchone()
+        )).fetchone()
         if dup:
             await msg.reply_text("Этот платёж уже учтён 👍")
             return
@@ -351,14 +350,13 @@ async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # Парсинг payload (формат: "pay:sub:30" или "pay:labs")
         if payload.startswith("pay:sub:"):
             days = int(payload.split(":")[2])
-            exp = activate_sub(user_id, days)
-            
-            db.execute(
-                "INSERT INTO payments (user_id, payload, currency, amount, provider_charge_id) "
-                "VALUES (%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING",
-                (user_id, payload, currency, amount, provider_charge_id)
-            )
-            db.commit()
+            async with adb.transaction() as tx:
+                exp = await activate_sub(user_id, days, tx)
+                await tx.execute(
+                    "INSERT INTO payments (user_id, payload, currency, amount, provider_charge_id) "
+                    "VALUES (%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING",
+                    (user_id, payload, currency, amount, provider_charge_id)
+                )
             
             await msg.reply_text(
                 f"✅ Подписка на {days} дней активирована до {exp.strftime('%d.%m.%Y')}!\n"
@@ -367,21 +365,13 @@ async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE)
             
         elif payload.startswith("pay:labs"):
             qty = 1
-            db.execute(
-                "INSERT INTO credits (user_id, labs_credits) VALUES (%s, 0) "
-                "ON CONFLICT (user_id) DO NOTHING",
-                (user_id,)
-            )
-            db.execute(
-                "UPDATE credits SET labs_credits = labs_credits + %s WHERE user_id = %s",
-                (qty, user_id)
-            )
-            db.execute(
-                "INSERT INTO payments (user_id, payload, currency, amount, provider_charge_id) "
-                "VALUES (%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING",
-                (user_id, payload, currency, amount, provider_charge_id)
-            )
-            db.commit()
+            async with adb.transaction() as tx:
+                await add_labs_credits(user_id, qty, tx)
+                await tx.execute(
+                    "INSERT INTO payments (user_id, payload, currency, amount, provider_charge_id) "
+                    "VALUES (%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING",
+                    (user_id, payload, currency, amount, provider_charge_id)
+                )
             
             await msg.reply_text(f"✅ Оплачено! Доступно {qty} анализ(а/ов). 🧪")
         else:
@@ -389,7 +379,6 @@ async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE)
             
     except Exception as e:
         logger.exception(f"Payment processing error: {e}")
-        db.rollback()
         await msg.reply_text(
             "❌ Ошибка при обработке платежа. Обратитесь в поддержку."
         )
@@ -411,11 +400,11 @@ async def promo_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     code = (context.args[0] or "").strip()
     user_id = update.effective_user.id
     
-    row = db.execute(
+    row = (await adb.execute(
         "SELECT days, labs_credits, max_uses, used_count, expires_at "
         "FROM promocodes WHERE code = %s",
         (code,)
-    ).fetchone()
+    )).fetchone()
     
     if not row:
         await update.message.reply_text("❌ Промокод не найден.")
@@ -451,33 +440,31 @@ async def promo_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         parts = []
-        if days > 0:
-            activate_sub(user_id, days)
-            parts.append(f"+{days} дней подписки")
-        if credits > 0:
-            db.execute(
-                "INSERT INTO credits (user_id, labs_credits) VALUES (%s, 0) "
-                "ON CONFLICT (user_id) DO NOTHING",
-                (user_id,)
-            )
-            db.execute(
-                "UPDATE credits SET labs_credits = labs_credits + %s WHERE user_id = %s",
-                (credits, user_id)
-            )
-            parts.append(f"+{credits} анализ(а/ов)")
+        async with adb.transaction() as tx:
+            # Использование засчитывается, только пока не исчерпан лимит
+            claimed = (await tx.execute(
+                "UPDATE promocodes SET used_count = COALESCE(used_count, 0) + 1 "
+                "WHERE code = %s AND (max_uses IS NULL OR COALESCE(used_count, 0) < max_uses) "
+                "RETURNING code",
+                (code,)
+            )).fetchone()
+            if claimed:
+                if days > 0:
+                    await activate_sub(user_id, days, tx)
+                    parts.append(f"+{days} дней подписки")
+                if credits > 0:
+                    await add_labs_credits(user_id, credits, tx)
+                    parts.append(f"+{credits} анализ(а/ов)")
         
-        db.execute(
-            "UPDATE promocodes SET used_count = COALESCE(used_count, 0) + 1 WHERE code = %s",
-            (code,)
-        )
-        db.commit()
+        if not claimed:
+            await update.message.reply_text("❌ Этот промокод исчерпан.")
+            return
         
         await update.message.reply_text(
             f"✅ Промокод применён: {', '.join(parts)}!"
         )
     except Exception as e:
         logger.exception(f"Promo apply error: {e}")
-        db.rollback()
         await update.message.reply_text("❌ Ошибка применения промокода.")
 
 
@@ -522,7 +509,7 @@ async def addpromo_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         expires_at = args[4]
     
     try:
-        db.execute(
+        await adb.execute(
             """
             INSERT INTO promocodes (code, days, labs_credits, max_uses, used_count, expires_at)
             VALUES (%s, %s, %s, %s, 0, %s)
@@ -534,7 +521,6 @@ async def addpromo_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             """,
             (code, days, labs_credits, max_uses, expires_at)
         )
-        db.commit()
         
         await update.message.reply_text(
             f"✅ Промокод {code} создан:\n"
@@ -545,7 +531,6 @@ async def addpromo_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     except Exception as e:
         logger.exception(f"Error creating promo: {e}")
-        db.rollback()
         await update.message.reply_text("❌ Ошибка создания промокода.")
 
 
@@ -575,9 +560,28 @@ async def handle_any_message(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # MAIN
 # ============================================
 
+async def post_init(app: Application):
+    """Открыть пул соединений с БД в event loop приложения"""
+    await adb.open()
+
+
+async def post_shutdown(app: Application):
+    await adb.close()
+
+
 def main():
     """Запуск бота"""
-    app = Application.builder().token(BOT_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if BOT_CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(
+            PerChatUpdateProcessor(BOT_CONCURRENT_UPDATES, BOT_MAX_PENDING_UPDATES)
+        )
+    app = builder.build()
     
     # Команды
     app.add_handler(CommandHandler("start", start_cmd))
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Параллельная обработка апдейтов с сохранением порядка внутри чата.
+
+Апдейты разных пользователей обрабатываются одновременно (не больше
+workers штук), апдейты одного чата - строго по очереди, в порядке
+получения. Пока чат ждёт своей очереди, он не занимает рабочий слот.
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict, Hashable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger("update_processor")
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    max_pending - сколько апдейтов одновременно принято в обработку
+    (включая ждущих очереди своего чата), workers - сколько из них
+    реально выполняются.
+    """
+
+    def __init__(self, workers: int, max_pending: Optional[int] = None):
+        super().__init__(max_pending or workers * 16)
+        self.workers = workers
+        self._worker_slots = asyncio.Semaphore(workers)
+        self._chat_locks: Dict[Hashable, asyncio.Lock] = {}
+        self._chat_waiting: Dict[Hashable, int] = {}
+
+    @staticmethod
+    def _chat_key(update: object) -> Optional[Hashable]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        # pre_checkout_query и т.п. приходят без чата
+        if update.effective_user:
+            return ("user", update.effective_user.id)
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self._chat_key(update)
+        if key is None:
+            async with self._worker_slots:
+                await coroutine
+            return
+
+        lock = self._chat_locks.get(key)
+        if lock is None:
+            lock = self._chat_locks[key] = asyncio.Lock()
+        self._chat_waiting[key] = self._chat_waiting.get(key, 0) + 1
+        try:
+            async with lock:
+                async with self._worker_slots:
+                    await coroutine
+        finally:
+            self._chat_waiting[key] -= 1
+            if not self._chat_waiting[key]:
+                del self._chat_waiting[key]
+                del self._chat_locks[key]
+
+    async def initialize(self) -> None:
+        logger.info(f"Concurrent updates: {self.workers} workers, {self.max_concurrent_updates} pending max")
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Инкрементальная выдача достижений после приёма пищи.
+
+Для каждого пользователя в памяти хранится скользящее состояние за последние
+7 дней (битовые маски по дням + счётчики приёмов). Новый приём пищи обновляет
+его за O(1), достижение выдаётся только при переходе условия в «выполнено».
+Состояние читается из БД один раз - при первом событии пользователя в процессе.
+События сопоставляются с загруженным состоянием по id приёма пищи, поэтому
+приём, уже попавший в загрузку из БД, не учитывается повторно.
+"""
+import os
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger("achievements")
+
+WINDOW_DAYS = 7
+FULL_MASK = (1 << WINDOW_DAYS) - 1
+BREAKFAST_HOURS = (5, 10)
+SUGAR_WORDS = ('сахар', 'торт', 'шоколад', 'печенье', 'конфет')
+ACHIEVEMENT_STATE_MAX_USERS = int(os.getenv("ACHIEVEMENT_STATE_MAX_USERS", "10000"))
+
+BADGE_BREAKFAST = "Завтрак-герой"
+BADGE_WATER = "Повелитель воды"
+BADGE_NO_SUGAR = "7 дней без сахара"
+
+
+class UserAchievementState:
+    """
+    Скользящее окно в WINDOW_DAYS дней.
+    Бит i масок и counts[i] относятся к дню anchor - i.
+    """
+    __slots__ = ("anchor", "breakfast", "water", "sugar", "counts", "awarded", "loaded_ids")
+
+    def __init__(self, anchor: int, awarded: Optional[set] = None, loaded_ids: frozenset = frozenset()):
+        self.anchor = anchor
+        self.breakfast = 0
+        self.water = 0
+        self.sugar = 0
+        self.counts = [0] * WINDOW_DAYS
+        self.awarded = awarded or set()
+        # id приёмов пищи, прочитанных из БД при загрузке состояния
+        self.loaded_ids = loaded_ids
+
+    def _advance(self, day: int):
+        """Сдвинуть окно так, чтобы day стал самым свежим днём"""
+        shift = day - self.anchor
+        if shift <= 0:
+            return
+        self.breakfast = (self.breakfast << shift) & FULL_MASK
+        self.water = (self.water << shift) & FULL_MASK
+        self.sugar = (self.sugar << shift) & FULL_MASK
+        keep = max(WINDOW_DAYS - shift, 0)
+        self.counts = [0] * (WINDOW_DAYS - keep) + self.counts[:keep]
+        self.anchor = day
+
+    def add_meal(self, ts: datetime, text: str):
+        day = ts.toordinal()
+        self._advance(day)
+        i = self.anchor - day
+        if i >= WINDOW_DAYS:
+            return  # старше окна
+
+        bit = 1 << i
+        text_lower = (text or '').lower()
+        if BREAKFAST_HOURS[0] <= ts.hour < BREAKFAST_HOURS[1]:
+            self.breakfast |= bit
+        if 'вода' in text_lower:
+            self.water |= bit
+        if any(word in text_lower for word in SUGAR_WORDS):
+            self.sugar |= bit
+        self.counts[i] += 1
+
+    def earned(self, today: int) -> List[str]:
+        """Условия, выполненные на сегодня, по которым ещё не выдан бейдж"""
+        self._advance(today)
+        badges = []
+        if bin(self.breakfast).count("1") >= WINDOW_DAYS:
+            badges.append(BADGE_BREAKFAST)
+        if self.water:
+            badges.append(BADGE_WATER)
+        if not self.sugar and sum(self.counts) >= 3 * WINDOW_DAYS:  # 3 приёма * 7 дней
+            badges.append(BADGE_NO_SUGAR)
+        return [b for b in badges if b not in self.awarded]
+
+
+class AchievementEngine:
+    """Состояния пользователей (LRU) и выдача бейджей"""
+
+    def __init__(self, max_users: int = ACHIEVEMENT_STATE_MAX_USERS):
+        self.max_users = max_users
+        self._states: "OrderedDict[int, UserAchievementState]" = OrderedDict()
+        self._pending: Dict[int, List[Tuple[int, datetime, str]]] = {}
+
+    def forget(self, user_id: int):
+        """Сбросить состояние (например, после удаления приёма пищи)"""
+        self._states.pop(user_id, None)
+
+    def _store(self, user_id: int, state: UserAchievementState):
+        self._states[user_id] = state
+        self._states.move_to_end(user_id)
+        while len(self._states) > self.max_users:
+            self._states.popitem(last=False)
+
+    async def _load(self, user_id: int, now: datetime) -> UserAchievementState:
+        """Восстановить состояние из БД (включает все уже сохранённые приёмы пищи)"""
+        from database_async import get_async_db
+
+        since = datetime.combine(
+            (now - timedelta(days=WINDOW_DAYS - 1)).date(), datetime.min.time(), now.tzinfo
+        )
+        async with get_async_db() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "SELECT id, ts, text FROM meals WHERE user_id = %s AND ts >= %s",
+                    (user_id, since)
+                )
+                meals = await cur.fetchall()
+                await cur.execute(
+                    "SELECT badge FROM achievements WHERE user_id = %s",
+                    (user_id,)
+                )
+                awarded = {row['badge'] for row in await cur.fetchall()}
+
+        state = UserAchievementState(now.toordinal(), awarded, frozenset(meal['id'] for meal in meals))
+        for meal in meals:
+            state.add_meal(meal['ts'].astimezone(now.tzinfo), meal['text'])
+        return state
+
+    def record_meal(self, user_id: int, meal_id: int, ts: datetime, text: str):
+        """Запомнить событие (после коммита приёма); обработка - в process() из фоновой очереди"""
+        self._pending.setdefault(user_id, []).append((meal_id, ts, text))
+
+    async def process(self, user_id: int):
+        """Применить накопленные события пользователя и выдать бейджи"""
+        from database_async import execute_update_async
+
+        events = self._pending.pop(user_id, [])
+        if not events:
+            return
+        now = events[-1][1]
+
+        try:
+            state = self._states.get(user_id)
+            if state is None:
+                # Загруженное из БД состояние уже содержит эти приёмы пищи
+                # (события пишутся после коммита); удалённые - наоборот, не содержит
+                state = await self._load(user_id, now)
+            else:
+                # Приёмы, сохранённые во время загрузки состояния, уже учтены ею
+                for meal_id, ts, text in events:
+                    if meal_id not in state.loaded_ids:
+                        state.add_meal(ts, text)
+            self._store(user_id, state)
+
+            badges = state.earned(now.toordinal())
+            if badges:
+                await execute_update_async(
+                    """
+                    INSERT INTO achievements (user_id, badge, ts)
+                    SELECT %s, unnest(%s::text[]), %s
+                    ON CONFLICT DO NOTHING
+                    """,
+                    (user_id, badges, now)
+                )
+                state.awarded.update(badges)
+                logger.info(f"Achievements awarded to user {user_id}: {badges}")
+
+        except Exception as e:
+            self.forget(user_id)
+            logger.exception(f"Error checking achievements for user {user_id}: {e}")
+
+
+# Глобальный экземпляр
+achievement_engine = AchievementEngine()
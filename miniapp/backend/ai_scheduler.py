@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Планировщик запросов к AI.
+
+- общий лимит одновременных запросов и лимиты на каждую модель;
+- ожидающие запросы делятся на классы приоритета (оценка еды раньше
+  длинной генерации плана), внутри класса пользователи обслуживаются
+  по кругу - один пользователь не занимает всю очередь;
+- при переполнении очереди запрос сразу отклоняется (AIQueueFull → 429).
+"""
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Hashable, List
+
+logger = logging.getLogger("ai_scheduler")
+
+# Классы приоритета (меньше - раньше)
+PRIORITY_MEAL = 0   # оценка приёма пищи
+PRIORITY_CHAT = 1   # анализы, рецепты
+PRIORITY_PLAN = 2   # план питания на неделю
+PRIORITIES = (PRIORITY_MEAL, PRIORITY_CHAT, PRIORITY_PLAN)
+
+AI_MAX_CONCURRENT = int(os.getenv("AI_MAX_CONCURRENT", "16"))
+AI_MODEL_MAX_CONCURRENT = int(os.getenv("AI_MODEL_MAX_CONCURRENT", "8"))
+AI_QUEUE_MAX_DEPTH = int(os.getenv("AI_QUEUE_MAX_DEPTH", "100"))
+
+
+def _parse_model_limits(raw: str) -> Dict[str, int]:
+    """Разбор AI_MODEL_CONCURRENCY вида 'model_a=4,model_b=10'"""
+    result = {}
+    for part in raw.split(","):
+        if "=" in part:
+            model, value = part.rsplit("=", 1)
+            try:
+                result[model.strip()] = int(value)
+            except ValueError:
+                logger.warning(f"Bad limit in AI_MODEL_CONCURRENCY: {part!r}")
+    return result
+
+
+AI_MODEL_CONCURRENCY = _parse_model_limits(os.getenv("AI_MODEL_CONCURRENCY", ""))
+
+
+class AIQueueFull(RuntimeError):
+    """Очередь запросов к AI переполнена"""
+
+
+class AIScheduler:
+    """Справедливая очередь к ограниченному числу слотов AI"""
+
+    def __init__(
+        self,
+        max_concurrent: int = AI_MAX_CONCURRENT,
+        model_limit: int = AI_MODEL_MAX_CONCURRENT,
+        max_queue: int = AI_QUEUE_MAX_DEPTH
+    ):
+        self.max_concurrent = max_concurrent
+        self.model_limit = model_limit
+        self.max_queue = max_queue
+        self._free = max_concurrent
+        # приоритет → user_id → ожидающие запросы пользователя (в порядке поступления)
+        self._queues: List["OrderedDict[Hashable, Deque[asyncio.Future]]"] = [OrderedDict() for _ in PRIORITIES]
+        self._models: Dict[str, asyncio.Semaphore] = {}
+        self.waiting = 0
+        self.granted = 0
+        self.rejected = 0
+        self._wait_total = 0.0
+        self.max_wait = 0.0
+
+    def check_capacity(self):
+        """Отклонить заранее, если запрос заведомо не поместится в очередь"""
+        if self._free <= 0 and self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise AIQueueFull("AI queue is full")
+
+    async def acquire(self, user_id: Hashable, priority: int = PRIORITY_CHAT):
+        if self._free > 0 and not self.waiting:
+            self._free -= 1
+            self.granted += 1
+            return
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise AIQueueFull("AI queue is full")
+
+        fut = asyncio.get_running_loop().create_future()
+        self._queues[priority].setdefault(user_id, deque()).append(fut)
+        self.waiting += 1
+        started = time.monotonic()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.cancelled():
+                self._discard(priority, user_id, fut)
+            else:
+                # слот выдан одновременно с отменой - возвращаем его
+                self.release()
+            raise
+        wait = time.monotonic() - started
+        self._wait_total += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.granted += 1
+
+    def release(self):
+        self._free += 1
+        while self._free > 0:
+            fut = self._next()
+            if fut is None:
+                return
+            self._free -= 1
+            fut.set_result(None)
+
+    def _next(self):
+        """Первый запрос следующего по кругу пользователя из самого приоритетного класса"""
+        for users in self._queues:
+            if users:
+                user_id, waiters = users.popitem(last=False)
+                fut = waiters.popleft()
+                if waiters:
+                    users[user_id] = waiters
+                self.waiting -= 1
+                return fut
+        return None
+
+    def _discard(self, priority: int, user_id: Hashable, fut: asyncio.Future):
+        users = self._queues[priority]
+        waiters = users.get(user_id)
+        if waiters is None or fut not in waiters:
+            return
+        waiters.remove(fut)
+        if not waiters:
+            del users[user_id]
+        self.waiting -= 1
+
+    @asynccontextmanager
+    async def slot(self, user_id: Hashable, priority: int = PRIORITY_CHAT):
+        """Общий слот на всё время запроса (включая переход на запасные модели)"""
+        await self.acquire(user_id, priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def model_slot(self, model: str) -> asyncio.Semaphore:
+        """Семафор модели: async with scheduler.model_slot(model)"""
+        sem = self._models.get(model)
+        if sem is None:
+            sem = asyncio.Semaphore(AI_MODEL_CONCURRENCY.get(model, self.model_limit))
+            self._models[model] = sem
+        return sem
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.max_concurrent - self._free,
+            "waiting": self.waiting,
+            "waiting_by_priority": [sum(len(w) for w in users.values()) for users in self._queues],
+            "granted": self.granted,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self._wait_total / self.granted * 1000, 1) if self.granted else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 1)
+        }
+
+
+# Глобальный экземпляр
+ai_scheduler = AIScheduler()
@@ -4,15 +4,51 @@
 КРИТИЧЕСКИ ВАЖНО для безопасности!
 """
 import os
+import time
 import hmac
 import hashlib
 import json
+from collections import OrderedDict
 from urllib.parse import parse_qsl, unquote
 from fastapi import HTTPException, Header
-from typing import Optional
+from typing import Optional, Tuple
 
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
+# Срок жизни initData (по auth_date) и размер кэша проверенных строк
+INIT_DATA_MAX_AGE = int(os.getenv("INIT_DATA_MAX_AGE_SECONDS", "86400"))
+INIT_DATA_CACHE_SIZE = int(os.getenv("INIT_DATA_CACHE_SIZE", "10000"))
+
+# secret_key зависит только от токена - считаем один раз при старте
+SECRET_KEY = hmac.new(
+    key=b"WebAppData",
+    msg=BOT_TOKEN.encode(),
+    digestmod=hashlib.sha256
+).digest() if BOT_TOKEN else None
+
+# sha256(initData) -> (истекает в, данные пользователя)
+# Mini App шлёт один и тот же initData на каждый запрос сессии
+_verified_cache: "OrderedDict[bytes, Tuple[float, dict]]" = OrderedDict()
+
+
+def _cache_get(key: bytes) -> Optional[dict]:
+    item = _verified_cache.get(key)
+    if not item:
+        return None
+    expires, user = item
+    if expires <= time.time():
+        del _verified_cache[key]
+        return None
+    _verified_cache.move_to_end(key)
+    return user
+
+
+def _cache_put(key: bytes, expires: float, user: dict):
+    _verified_cache[key] = (expires, user)
+    _verified_cache.move_to_end(key)
+    while len(_verified_cache) > INIT_DATA_CACHE_SIZE:
+        _verified_cache.popitem(last=False)
+
 def verify_telegram_webapp_data(init_data: str) -> dict:
     """
     Проверяет что данные действительно от Telegram
@@ -20,6 +56,9 @@ def verify_telegram_webapp_data(init_data: str) -> dict:
     Алгоритм из документации Telegram:
     https://core.telegram.org/bots/webapps#validating-data-received-via-the-mini-app
     
+    Уже проверенные строки кэшируются до истечения auth_date + INIT_DATA_MAX_AGE,
+    повторные запросы сессии не пересчитывают HMAC.
+    
     Args:
         init_data: строка initData от Telegram.WebApp
     
@@ -29,6 +68,14 @@ def verify_telegram_webapp_data(init_data: str) -> dict:
     Raises:
         HTTPException: если данные невалидны
     """
+    cache_key = hashlib.sha256(init_data.encode()).digest()
+    cached = _cache_get(cache_key)
+    if cached:
+        return cached
+    
+    if SECRET_KEY is None:
+        raise HTTPException(status_code=500, detail="TELEGRAM_BOT_TOKEN is not configured")
+    
     try:
         # Парсим данные
         parsed = dict(parse_qsl(init_data, keep_blank_values=True))
@@ -42,28 +89,27 @@ def verify_telegram_webapp_data(init_data: str) -> dict:
         data_check_array = [f"{k}={v}" for k, v in sorted(parsed.items())]
         data_check_string = '\n'.join(data_check_array)
         
-        # Создаём secret_key
-        secret_key = hmac.new(
-            key=b"WebAppData",
-            msg=BOT_TOKEN.encode(),
-            digestmod=hashlib.sha256
-        ).digest()
-        
         # Вычисляем hash
         calculated_hash = hmac.new(
-            key=secret_key,
+            key=SECRET_KEY,
             msg=data_check_string.encode(),
             digestmod=hashlib.sha256
         ).hexdigest()
         
-        # Проверяем hash
-        if calculated_hash != received_hash:
+        # Проверяем hash (сравнение за постоянное время)
+        if not hmac.compare_digest(calculated_hash, received_hash):
             raise HTTPException(status_code=401, detail="Invalid hash")
         
+        # Проверяем срок действия
+        auth_date = int(parsed.get('auth_date') or 0)
+        expires = auth_date + INIT_DATA_MAX_AGE
+        if expires <= time.time():
+            raise HTTPException(status_code=401, detail="Init data expired")
+        
         # Парсим user данные
         user_data = json.loads(unquote(parsed.get('user', '{}')))
         
-        return {
+        user = {
             'user_id': user_data.get('id'),
             'username': user_data.get('username'),
             'first_name': user_data.get('first_name'),
@@ -71,7 +117,11 @@ def verify_telegram_webapp_data(init_data: str) -> dict:
             'auth_date': parsed.get('auth_date'),
             'raw_data': parsed
         }
+        _cache_put(cache_key, expires, user)
+        return user
         
+    except HTTPException:
+        raise
     except json.JSONDecodeError as e:
         raise HTTPException(status_code=401, detail=f"Invalid JSON: {str(e)}")
     except Exception as e:
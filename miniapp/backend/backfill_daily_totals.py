@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Заполнение таблицы meal_daily_totals по существующим записям meals.
+
+Использование:
+    python backfill_daily_totals.py              # все пользователи
+    python backfill_daily_totals.py --user 123   # один пользователь
+
+Итоги пересчитываются заново в одной транзакции, скрипт можно запускать повторно.
+"""
+import argparse
+import logging
+
+from database import get_db
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+)
+logger = logging.getLogger("backfill_daily_totals")
+
+
+def backfill(user_id: int = None) -> int:
+    """Пересчитать дневные итоги; возвращает число записанных строк"""
+    user_filter = "WHERE user_id = %(user_id)s" if user_id is not None else ""
+    params = {"user_id": user_id}
+
+    with get_db() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"DELETE FROM meal_daily_totals {user_filter}", params)
+            cur.execute(
+                f"""
+                INSERT INTO meal_daily_totals
+                    (user_id, local_date, meal_count, calories, proteins, fats, carbs)
+                SELECT user_id,
+                       COALESCE(local_day, (ts AT TIME ZONE 'UTC')::date),
+                       COUNT(*),
+                       COALESCE(SUM(calories), 0),
+                       COALESCE(SUM(proteins), 0),
+                       COALESCE(SUM(fats), 0),
+                       COALESCE(SUM(carbs), 0)
+                FROM meals
+                {user_filter}
+                GROUP BY 1, 2
+                """,
+                params
+            )
+            rows = cur.rowcount
+        conn.commit()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill meal_daily_totals from meals")
+    parser.add_argument("--user", type=int, default=None, help="только этот user_id")
+    args = parser.parse_args()
+
+    rows = backfill(args.user)
+    logger.info(f"✅ meal_daily_totals: {rows} rows written")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,25 @@
 # -*- coding: utf-8 -*-
 """
 Переиспользуемые функции из бота для backend.
-ИСПРАВЛЕННАЯ ВЕРСИЯ - совместима с openai 1.12.0
+ИСПРАВЛЕННАЯ ВЕРСИЯ - использует AsyncOpenAI (openai>=1.40)
 """
 
 import os
 import re
 import json
+import time
 import asyncio
 import logging
-from typing import Optional, Dict, List, Tuple
+from typing import AsyncIterator, Optional, Dict, List, Tuple
 from datetime import datetime, timezone
 
 # ⭐ ДОБАВЬТЕ ЭТИ СТРОКИ В САМОЕ НАЧАЛО
 from dotenv import load_dotenv
 load_dotenv()  # Загружаем переменные окружения
 
+from ai_scheduler import ai_scheduler, PRIORITY_CHAT, PRIORITY_MEAL
+from model_health import model_health
+
 logger = logging.getLogger("bot_functions")
 
 # ===== Конфигурация =====
@@ -36,20 +40,52 @@ FALLBACK_MODELS = [
     "anthropic/claude-3-haiku",
 ]
 
+
+def _parse_model_timeouts(raw: str) -> Dict[str, float]:
+    """Разбор AI_MODEL_TIMEOUTS вида 'model_a=20,model_b=45'"""
+    result = {}
+    for part in raw.split(","):
+        if "=" in part:
+            model, value = part.rsplit("=", 1)
+            try:
+                result[model.strip()] = float(value)
+            except ValueError:
+                logger.warning(f"Bad timeout in AI_MODEL_TIMEOUTS: {part!r}")
+    return result
+
+
+# Таймаут одного запроса к модели (сек), можно переопределить для отдельных моделей
+AI_TIMEOUT = float(os.getenv("AI_TIMEOUT_SECONDS", "60"))
+AI_MODEL_TIMEOUTS = _parse_model_timeouts(os.getenv("AI_MODEL_TIMEOUTS", ""))
+# Хеджирование: если модель не ответила за N сек - параллельно запускаем следующую.
+# 0 - выключено, модели опрашиваются по очереди.
+AI_HEDGE_DELAY = float(os.getenv("AI_HEDGE_DELAY_SECONDS", "0"))
+# Повторы внутри клиента; запасные модели и так играют роль повторов
+AI_MAX_RETRIES = int(os.getenv("AI_MAX_RETRIES", "0"))
+
+
+class AIUnavailableError(RuntimeError):
+    """Ни одна модель не вернула ответ"""
+
 # В начале файла bot_functions.py, замените секцию инициализации AI:
 
 ## ===== Инициализация AI =====
 # ===== Инициализация AI =====
 ai = None
 AI_AVAILABLE = False
+# Ошибки «ответа не дождались» - учитываются в задержке модели
+AI_TIMEOUT_ERRORS = (asyncio.TimeoutError,)
 
 try:
-    from openai import OpenAI
+    from openai import AsyncOpenAI, APITimeoutError
+    AI_TIMEOUT_ERRORS = (asyncio.TimeoutError, APITimeoutError)
     if OPENROUTER_KEY:
-        # Простая инициализация - только api_key и base_url
-        ai = OpenAI(
+        # Асинхронный клиент: запросы не занимают потоки executor'а
+        ai = AsyncOpenAI(
             api_key=OPENROUTER_KEY,
-            base_url="https://openrouter.ai/api/v1"
+            base_url="https://openrouter.ai/api/v1",
+            timeout=AI_TIMEOUT,
+            max_retries=AI_MAX_RETRIES
         )
         AI_AVAILABLE = True
         logger.info("✅ AI client initialized")
@@ -63,34 +99,211 @@ except Exception as e:
     logger.error(traceback.format_exc())
 
 
-async def ai_chat(system: str, user_text: str, temperature: float = 0.5) -> str:
-    """Запрос к AI-модели"""
-    if not AI_AVAILABLE:
-        return "AI не настроен. Установите OPENROUTER_API_KEY в .env"
+def _model_timeout(model: str) -> float:
+    return AI_MODEL_TIMEOUTS.get(model, AI_TIMEOUT)
 
-    def _call(model: str):
-        return ai.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": user_text}
-            ],
-            temperature=temperature
-            # Убрали extra_headers - они добавляются через base_url
+
+async def _call_model(model: str, messages: List[dict], temperature: float) -> str:
+    """Один запрос к конкретной модели; пустой ответ считается ошибкой"""
+    if not model_health.begin(model):
+        raise AIUnavailableError(f"Model {model} circuit is open")
+    started = None  # ожидание семафора модели - не вина модели
+    try:
+        async with ai_scheduler.model_slot(model):
+            started = time.monotonic()
+            resp = await ai.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                timeout=_model_timeout(model)
+            )
+        content = resp.choices[0].message.content if resp.choices else None
+        if not content:
+            raise AIUnavailableError(f"Model {model} returned empty response")
+    except asyncio.CancelledError:
+        # Отменён без ответа (проиграл хеджирование) - медленный ответ, а не «ничего»
+        model_health.cancel(model, time.monotonic() - started if started else 0.0)
+        raise
+    except Exception as e:
+        model_health.record_failure(
+            model,
+            time.monotonic() - started if started else 0.0,
+            timeout=isinstance(e, AI_TIMEOUT_ERRORS)
         )
+        raise
+    model_health.record_success(model, time.monotonic() - started)
+    return content.strip()
+
 
-    for model in [PRIMARY_MODEL] + FALLBACK_MODELS:
+async def _complete_sequential(models: List[str], messages: List[dict], temperature: float) -> str:
+    """Модели по очереди: следующая - только после ошибки предыдущей"""
+    for model in models:
         try:
-            resp = await asyncio.to_thread(_call, model)
-            if hasattr(resp, "choices") and resp.choices:
-                content = resp.choices[0].message.content
-                if content:
-                    return content.strip()
+            return await _call_model(model, messages, temperature)
         except Exception as e:
             logger.warning(f"Model {model} failed: {e}")
-            continue
+    raise AIUnavailableError("All models failed")
+
 
-    return "Все AI модели недоступны"
+async def _complete_hedged(models: List[str], messages: List[dict], temperature: float, delay: float) -> str:
+    """
+    Хеджированный запрос: если текущая модель не ответила за delay сек
+    (или упала) - запускаем следующую. Берём первый успешный ответ,
+    остальные запросы отменяем.
+    """
+    queue = list(models)
+    pending: Dict[asyncio.Task, str] = {}
+
+    def launch():
+        model = queue.pop(0)
+        task = asyncio.create_task(_call_model(model, messages, temperature))
+        pending[task] = model
+
+    launch()
+    try:
+        while pending:
+            done, _ = await asyncio.wait(
+                pending,
+                timeout=delay if queue else None,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                launch()
+                continue
+            for task in done:
+                model = pending.pop(task)
+                if task.exception() is None:
+                    return task.result()
+                logger.warning(f"Model {model} failed: {task.exception()}")
+                if queue:
+                    launch()
+        raise AIUnavailableError("All models failed")
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def ai_chat(
+    system: str,
+    user_text: str,
+    temperature: float = 0.5,
+    strict: bool = False,
+    user_id: Optional[int] = None,
+    priority: int = PRIORITY_CHAT
+) -> str:
+    """
+    Запрос к AI-модели.
+    strict=True - при недоступности всех моделей пробрасывать AIUnavailableError
+    вместо текста-заглушки (когда результат сохраняется или за него списана оплата).
+    user_id и priority - место в очереди планировщика; при переполнении
+    очереди бросается AIQueueFull.
+    """
+    if not AI_AVAILABLE:
+        return "AI не настроен. Установите OPENROUTER_API_KEY в .env"
+
+    messages = [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user_text}
+    ]
+    # Здоровые и быстрые модели - первыми, разомкнутые - в конце
+    models = model_health.order([PRIMARY_MODEL] + FALLBACK_MODELS)
+
+    try:
+        async with ai_scheduler.slot(user_id, priority):
+            if AI_HEDGE_DELAY > 0:
+                return await _complete_hedged(models, messages, temperature, AI_HEDGE_DELAY)
+            return await _complete_sequential(models, messages, temperature)
+    except AIUnavailableError:
+        if strict:
+            raise
+        return "Все AI модели недоступны"
+
+
+async def _stream_model(model: str, messages: List[dict], temperature: float) -> AsyncIterator[str]:
+    """
+    Потоковый запрос к конкретной модели: непустые фрагменты ответа.
+    Для статистики модели задержка - время до первого фрагмента.
+    """
+    if not model_health.begin(model):
+        raise AIUnavailableError(f"Model {model} circuit is open")
+    started = None  # ожидание семафора модели - не вина модели
+    first = True
+    try:
+        async with ai_scheduler.model_slot(model):
+            started = time.monotonic()
+            stream = await ai.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                timeout=_model_timeout(model),
+                stream=True
+            )
+            # Закрываем HTTP-ответ и при обрыве клиента, иначе соединение висит до таймаута
+            async with stream:
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if first:
+                            model_health.record_success(model, time.monotonic() - started)
+                            first = False
+                        yield chunk.choices[0].delta.content
+    except (asyncio.CancelledError, GeneratorExit):
+        # Отмена и в ожидании семафора: иначе пробный запрос half-open не завершится
+        if first:
+            model_health.cancel(model, time.monotonic() - started if started else 0.0)
+        raise
+    except Exception as e:
+        # Вызов уже учтён как успешный по первому фрагменту - второй раз не считаем
+        if first:
+            model_health.record_failure(
+                model,
+                time.monotonic() - started if started else 0.0,
+                timeout=isinstance(e, AI_TIMEOUT_ERRORS)
+            )
+        raise
+    if first:
+        model_health.record_failure(model, time.monotonic() - started)
+
+
+async def ai_chat_stream(
+    system: str,
+    user_text: str,
+    temperature: float = 0.5,
+    user_id: Optional[int] = None,
+    priority: int = PRIORITY_CHAT
+) -> AsyncIterator[str]:
+    """
+    Запрос к AI с выдачей ответа по мере генерации.
+    На запасную модель переключаемся, только пока не получен первый фрагмент;
+    обрыв посреди ответа пробрасывается вызывающему коду.
+    """
+    if not AI_AVAILABLE:
+        yield "AI не настроен. Установите OPENROUTER_API_KEY в .env"
+        return
+
+    messages = [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user_text}
+    ]
+    async with ai_scheduler.slot(user_id, priority):
+        for model in model_health.order([PRIMARY_MODEL] + FALLBACK_MODELS):
+            chunks = _stream_model(model, messages, temperature)
+            try:
+                first = await chunks.__anext__()
+            except StopAsyncIteration:
+                logger.warning(f"Model {model} returned empty response")
+                continue
+            except Exception as e:
+                logger.warning(f"Model {model} failed: {e}")
+                continue
+
+            try:
+                yield first
+                async for piece in chunks:
+                    yield piece
+            finally:
+                await chunks.aclose()
+            return
+    raise AIUnavailableError("All models failed")
 
 
 def parse_meal_json(text: str) -> Tuple[int, float, float, float, str]:
@@ -114,11 +327,79 @@ def parse_meal_json(text: str) -> Tuple[int, float, float, float, str]:
     return 200, 10.0, 10.0, 20.0, "приём пищи"
 
 
+async def estimate_meal_with_ai(meal_text: str, user_id: Optional[int] = None) -> Tuple[int, float, float, float, str]:
+    """
+    Оценка приёма пищи через AI.
+    Бросает исключение, если в ответе нет корректного JSON.
+    """
+    system = 'Ты нутрициолог. Верни ТОЛЬКО JSON: {"calories": int, "proteins": float, "fats": float, "carbs": float, "summary": "text"}'
+    prompt = f'Оцени приём пищи и верни JSON в формате, например:\n{{"calories": 450, "proteins": 25.5, "fats": 12.0, "carbs": 50.0, "summary": "кратко"}}\n\nТекст: {meal_text}'
+    
+    response = await ai_chat(system, prompt, 0.2, user_id=user_id, priority=PRIORITY_MEAL)
+    match = re.search(r'\{.*\}', response, flags=re.S)
+    if not match:
+        raise ValueError("No JSON in AI response")
+    
+    data = json.loads(match.group(0))
+    return (
+        int(data.get('calories', 0)),
+        float(data.get('proteins', 0.0)),
+        float(data.get('fats', 0.0)),
+        float(data.get('carbs', 0.0)),
+        str(data.get('summary', meal_text))
+    )
+
+
+async def estimate_meals_with_ai(meal_texts: List[str], user_id: Optional[int] = None) -> List[Optional[Tuple[int, float, float, float, str]]]:
+    """
+    Оценка нескольких приёмов пищи одним запросом к AI.
+    Возвращает список той же длины; None - для приёмов, которых нет
+    в ответе или которые не удалось разобрать. Если AI недоступен -
+    AIUnavailableError, если в ответе нет JSON-массива - ValueError.
+    """
+    system = (
+        'Ты нутрициолог. Верни ТОЛЬКО JSON-массив, по одному объекту на каждый приём пищи: '
+        '{"id": int, "calories": int, "proteins": float, "fats": float, "carbs": float, "summary": "text"}'
+    )
+    lines = "\n".join(f"{n}. {text}" for n, text in enumerate(meal_texts, start=1))
+    prompt = (
+        'Оцени каждый приём пищи из списка. id - номер приёма в списке. Пример ответа:\n'
+        '[{"id": 1, "calories": 450, "proteins": 25.5, "fats": 12.0, "carbs": 50.0, "summary": "кратко"}]\n\n'
+        f'Приёмы пищи:\n{lines}'
+    )
+    
+    # strict: при недоступности AI пакет падает целиком, без поштучных повторов
+    response = await ai_chat(system, prompt, 0.2, strict=True, user_id=user_id, priority=PRIORITY_MEAL)
+    match = re.search(r'\[.*\]', response, flags=re.S)
+    if not match:
+        raise ValueError("No JSON array in AI response")
+    
+    items = json.loads(match.group(0))
+    results: List[Optional[Tuple[int, float, float, float, str]]] = [None] * len(meal_texts)
+    for position, data in enumerate(items):
+        if not isinstance(data, dict):
+            continue
+        try:
+            index = int(data.get('id', position + 1)) - 1
+            if not 0 <= index < len(meal_texts) or results[index] is not None:
+                continue
+            results[index] = (
+                int(data.get('calories', 0)),
+                float(data.get('proteins', 0.0)),
+                float(data.get('fats', 0.0)),
+                float(data.get('carbs', 0.0)),
+                str(data.get('summary', meal_texts[index]))
+            )
+        except (TypeError, ValueError):
+            continue
+    return results
+
+
 # ===== Функции для работы с БД =====
 
 def try_estimate_meal_from_db(meal_text: str) -> Optional[Tuple[int, float, float, float, str]]:
-    """Оценка еды из базы продуктов"""
-    from database import execute_query
+    """Оценка еды по справочнику продуктов (в памяти, без запросов к БД)"""
+    from product_catalog import catalog
     import html
     
     items = []
@@ -135,13 +416,9 @@ def try_estimate_meal_from_db(meal_text: str) -> Optional[Tuple[int, float, floa
     found = False
     
     for name, grams in items:
-        result = execute_query(
-            "SELECT * FROM products WHERE LOWER(name) = %s",
-            (name.lower(),)
-        )
+        prod = catalog.lookup(name)
         
-        if result:
-            prod = result[0]
+        if prod:
             found = True
             k = grams / 100
             total["kcal"] += prod["kcal_per_100"] * k
@@ -162,15 +439,15 @@ def try_estimate_meal_from_db(meal_text: str) -> Optional[Tuple[int, float, floa
     )
 
 
-def has_access(user_id: int, username: Optional[str] = None) -> bool:
+async def has_access(user_id: int, username: Optional[str] = None) -> bool:
     """Проверка доступа"""
-    from database import execute_query
+    from database_async import execute_query_async
     
     admin = os.getenv("ADMIN_USERNAME", "").lower()
     if username and username.lower() == admin and admin:
         return True
     
-    result = execute_query(
+    result = await execute_query_async(
         "SELECT expires_at, free_until FROM subscriptions WHERE user_id = %s",
         (user_id,)
     )
@@ -189,39 +466,76 @@ def has_access(user_id: int, username: Optional[str] = None) -> bool:
     return False
 
 
-def get_labs_credits(user_id: int) -> int:
+async def get_labs_credits(user_id: int) -> int:
     """Получить кредиты на анализы"""
-    from database import execute_query
+    from database_async import execute_query_async
     
-    result = execute_query(
+    result = await execute_query_async(
         "SELECT labs_credits FROM credits WHERE user_id = %s",
         (user_id,)
     )
     return result[0]["labs_credits"] if result else 0
 
 
-def consume_labs_credit(user_id: int) -> bool:
-    """Списать кредит"""
-    from database import execute_update
+async def charge_labs_credit(user_id: int) -> Optional[str]:
+    """
+    Списать один анализ одним запросом: сначала бесплатная попытка,
+    иначе кредит (условный UPDATE - баланс не уходит в минус при
+    одновременных запросах). Возвращает "free", "credit" или None,
+    если списать нечего.
+    """
+    from database_async import execute_query_async
     
-    try:
-        if get_labs_credits(user_id) <= 0:
-            return False
-        execute_update(
-            "UPDATE credits SET labs_credits = labs_credits - 1 WHERE user_id = %s",
-            (user_id,)
+    rows = await execute_query_async(
+        """
+        WITH f AS (
+            UPDATE subscriptions SET used_free_lab = TRUE
+            WHERE user_id = %(user_id)s AND NOT COALESCE(used_free_lab, FALSE)
+            RETURNING 'free'::text AS kind
+        ), c AS (
+            UPDATE credits SET labs_credits = labs_credits - 1
+            WHERE user_id = %(user_id)s AND labs_credits > 0
+              AND NOT EXISTS (SELECT 1 FROM f)
+            RETURNING 'credit'::text AS kind
         )
-        return True
-    except:
-        return False
+        SELECT kind FROM f
+        UNION ALL
+        SELECT kind FROM c
+        """,
+        {"user_id": user_id}
+    )
+    return rows[0]["kind"] if rows else None
+
+
+async def refund_labs_credit(user_id: int, kind: Optional[str]):
+    """Вернуть списанное charge_labs_credit (если анализ не удался)"""
+    from database_async import execute_update_async
+    
+    try:
+        if kind == "free":
+            await execute_update_async(
+                "UPDATE subscriptions SET used_free_lab = FALSE WHERE user_id = %s",
+                (user_id,)
+            )
+        elif kind == "credit":
+            await execute_update_async(
+                "UPDATE credits SET labs_credits = labs_credits + 1 WHERE user_id = %s",
+                (user_id,)
+            )
+    except Exception as e:
+        logger.error(f"Error refunding labs {kind} for user {user_id}: {e}")
 
 
-def init_challenge(user_id: int, challenge_type: str) -> bool:
+# Сколько отмеченных дней нужно для завершения челленджа
+CHALLENGE_DAYS = 7
+
+
+async def init_challenge(user_id: int, challenge_type: str) -> bool:
     """Инициализировать челлендж"""
-    from database import execute_update
+    from database_async import execute_update_async
     
     try:
-        execute_update(
+        await execute_update_async(
             """
             INSERT INTO challenges (user_id, challenge_type, start_date, progress, completed)
             VALUES (%s, %s, %s, 0, 0)
@@ -234,57 +548,51 @@ def init_challenge(user_id: int, challenge_type: str) -> bool:
         return False
 
 
-def update_challenge_progress(user_id: int, challenge_type: str) -> bool:
-    """Обновить прогресс челленджа"""
-    from database import execute_query, execute_update
+async def update_challenge_progress(user_id: int, challenge_type: str) -> bool:
+    """
+    Отметить день челленджа.
+    Один запрос: лог дня (повторная отметка за день не проходит по первичному
+    ключу, в том числе при одновременных нажатиях) → прогресс и признак
+    завершения → достижение. Возвращает False, если день уже отмечен
+    или челлендж не начат.
+    """
+    from database_async import execute_query_async
     
     try:
-        today = datetime.now(timezone.utc).date().isoformat()
-        
-        # Проверка
-        existing = execute_query(
-            "SELECT 1 FROM challenge_logs WHERE user_id=%s AND challenge_type=%s AND log_date=%s",
-            (user_id, challenge_type, today)
-        )
-        
-        if existing:
-            return False
-        
-        # Добавляем лог
-        execute_update(
-            "INSERT INTO challenge_logs (user_id, challenge_type, log_date, completed) VALUES (%s, %s, %s, 1)",
-            (user_id, challenge_type, today)
-        )
-        
-        # Обновляем прогресс
-        execute_update(
-            "UPDATE challenges SET progress = progress + 1 WHERE user_id=%s AND challenge_type=%s",
-            (user_id, challenge_type)
-        )
-        
-        # Проверяем завершение
-        challenge = execute_query(
-            "SELECT progress FROM challenges WHERE user_id=%s AND challenge_type=%s",
-            (user_id, challenge_type)
-        )
-        
-        if challenge and challenge[0]["progress"] >= 7:
-            execute_update(
-                "UPDATE challenges SET completed = 1 WHERE user_id=%s AND challenge_type=%s",
-                (user_id, challenge_type)
-            )
-            
-            achievement_name = f"Челлендж: {get_challenge_name(challenge_type)}"
-            execute_update(
-                """
+        rows = await execute_query_async(
+            """
+            WITH l AS (
+                INSERT INTO challenge_logs (user_id, challenge_type, log_date, completed)
+                SELECT user_id, challenge_type, %(today)s, 1
+                FROM challenges
+                WHERE user_id = %(user_id)s AND challenge_type = %(challenge_type)s
+                ON CONFLICT (user_id, challenge_type, log_date) DO NOTHING
+                RETURNING user_id, challenge_type
+            ), p AS (
+                UPDATE challenges c
+                SET progress = c.progress + 1,
+                    completed = CASE WHEN c.progress + 1 >= %(days)s THEN 1 ELSE c.completed END
+                FROM l
+                WHERE c.user_id = l.user_id AND c.challenge_type = l.challenge_type
+                RETURNING c.user_id, c.progress, c.completed
+            ), a AS (
                 INSERT INTO achievements (user_id, badge, ts)
-                VALUES (%s, %s, %s)
+                SELECT user_id, %(badge)s, now()
+                FROM p
+                WHERE completed = 1
                 ON CONFLICT (user_id, badge) DO NOTHING
-                """,
-                (user_id, achievement_name, datetime.now(timezone.utc))
             )
-        
-        return True
+            SELECT progress, completed FROM p
+            """,
+            {
+                "user_id": user_id,
+                "challenge_type": challenge_type,
+                "today": datetime.now(timezone.utc).date(),
+                "days": CHALLENGE_DAYS,
+                "badge": f"Челлендж: {get_challenge_name(challenge_type)}"
+            }
+        )
+        return bool(rows)
     except Exception as e:
         logger.error(f"Error updating challenge: {e}")
         return False
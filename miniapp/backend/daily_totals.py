@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Кэш дневных итогов (калории/БЖУ/число приёмов) по пользователям.
+Источник - таблица meal_daily_totals (одна строка на пользователя и день).
+Общий для /api/diary/week и /api/stats/weekly; при добавлении и удалении
+приёма пищи записи пользователя обновляются на месте, без обращения к БД.
+Если запись изменилась, пока итоги пользователя читались из БД, прочитанное
+не кэшируется: неизвестно, учтён ли в нём этот приём.
+"""
+import os
+import time
+import logging
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+from typing import Dict, List
+
+logger = logging.getLogger("daily_totals")
+
+DAILY_TOTALS_TTL = int(os.getenv("DAILY_TOTALS_CACHE_TTL_SECONDS", "300"))
+DAILY_TOTALS_MAX_USERS = int(os.getenv("DAILY_TOTALS_CACHE_MAX_USERS", "10000"))
+
+
+class _Entry:
+    __slots__ = ("tz", "since", "days", "expires")
+
+    def __init__(self, tz: ZoneInfo, since: date, days: Dict[date, dict], expires: float):
+        self.tz = tz
+        self.since = since
+        self.days = days
+        self.expires = expires
+
+
+def _empty_day(day: date) -> dict:
+    return {"day": day, "meal_count": 0, "calories": 0, "proteins": 0.0, "fats": 0.0, "carbs": 0.0}
+
+
+class DailyTotalsCache:
+    """user_id → {день: итоги} начиная с даты since (дни - в часовом поясе пользователя)"""
+
+    def __init__(self, ttl: int = DAILY_TOTALS_TTL, max_users: int = DAILY_TOTALS_MAX_USERS):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        # Только для пользователей, чьи итоги сейчас читаются: число чтений и версия
+        self._loading: Dict[int, int] = {}
+        self._versions: Dict[int, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def _load(self, user_id: int, num_days: int) -> _Entry:
+        """Итоги за последние num_days дней в часовом поясе пользователя"""
+        from database_async import execute_query_async
+
+        rows = await execute_query_async(
+            """
+            WITH u AS (
+                SELECT tz, (now() AT TIME ZONE tz)::date - %(days)s + 1 AS since
+                FROM (
+                    SELECT COALESCE(
+                        (SELECT tz FROM subscriptions WHERE user_id = %(user_id)s), 'UTC'
+                    ) AS tz
+                ) s
+            )
+            SELECT u.tz, u.since,
+                   t.local_date AS day, t.meal_count, t.calories, t.proteins, t.fats, t.carbs
+            FROM u
+            LEFT JOIN meal_daily_totals t
+                   ON t.user_id = %(user_id)s
+                  AND t.local_date >= u.since
+                  AND t.meal_count > 0
+            """,
+            {"user_id": user_id, "days": num_days}
+        )
+        days = {}
+        for row in rows:
+            if row["day"] is not None:
+                days[row["day"]] = {k: row[k] for k in ("day", "meal_count", "calories", "proteins", "fats", "carbs")}
+        return _Entry(ZoneInfo(rows[0]["tz"]), rows[0]["since"], days, time.monotonic() + self.ttl)
+
+    async def get_days(self, user_id: int, num_days: int) -> List[dict]:
+        """
+        Итоги за последние num_days дней (включая сегодня по часовому поясу
+        пользователя), только дни с приёмами, по возрастанию даты
+        """
+        entry = self._entries.get(user_id)
+        since = None
+        if entry and entry.expires > time.monotonic():
+            since = datetime.now(entry.tz).date() - timedelta(days=num_days - 1)
+            if entry.since > since:
+                since = None
+
+        if since is not None:
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+        else:
+            self.misses += 1
+            self._loading[user_id] = self._loading.get(user_id, 0) + 1
+            version = self._versions.setdefault(user_id, 0)
+            try:
+                entry = await self._load(user_id, num_days)
+                changed = self._versions[user_id] != version
+            finally:
+                self._loading[user_id] -= 1
+                if not self._loading[user_id]:
+                    del self._loading[user_id]
+                    del self._versions[user_id]
+            since = entry.since
+            if not changed:
+                self._entries[user_id] = entry
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_users:
+                    self._entries.popitem(last=False)
+
+        return [dict(entry.days[d]) for d in sorted(entry.days) if d >= since and entry.days[d]["meal_count"] > 0]
+
+    def _changed(self, user_id: int):
+        """Отметить изменение для идущих чтений итогов пользователя"""
+        if user_id in self._versions:
+            self._versions[user_id] += 1
+
+    def _patch(self, user_id: int, day: date, sign: int, meal: dict):
+        self._changed(user_id)
+        entry = self._entries.get(user_id)
+        if entry is None or day < entry.since:
+            return
+        totals = entry.days.setdefault(day, _empty_day(day))
+        totals["meal_count"] += sign
+        for field in ("calories", "proteins", "fats", "carbs"):
+            totals[field] += sign * (meal.get(field) or 0)
+        if totals["meal_count"] <= 0:
+            del entry.days[day]
+
+    def add_meal(self, user_id: int, day: date, meal: dict):
+        """Учесть добавленный приём пищи (если пользователь в кэше)"""
+        self._patch(user_id, day, 1, meal)
+
+    def remove_meal(self, user_id: int, day: date, meal: dict):
+        """Учесть удалённый приём пищи"""
+        self._patch(user_id, day, -1, meal)
+
+    def invalidate(self, user_id: int):
+        self._changed(user_id)
+        self._entries.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {"users": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+# Глобальный экземпляр
+daily_totals = DailyTotalsCache()
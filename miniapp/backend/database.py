@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 """
-Подключение к PostgreSQL - используем ту же БД что и в боте
+Подключение к PostgreSQL - используем ту же БД что и в боте.
+Синхронный доступ - для скриптов (бэкфилл, консоль); API работает
+через пул database_async.
 """
 import os
+import logging
 import psycopg
 from psycopg.rows import dict_row
 from contextlib import contextmanager
@@ -10,19 +13,24 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger("database")
+
 POSTGRES_DSN = os.getenv("POSTGRES_DSN")
 
+# Параметры пула соединений API (пул - в database_async)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # ожидание свободного коннекта из пула
+
+
 @contextmanager
 def get_db():
     """
-    Контекстный менеджер для работы с БД
-    Автоматически закрывает соединение
+    Контекстный менеджер для работы с БД из скриптов и консоли:
+    отдельное соединение на каждый вызов
     """
-    conn = psycopg.connect(POSTGRES_DSN, row_factory=dict_row)
-    try:
+    with psycopg.connect(POSTGRES_DSN, row_factory=dict_row) as conn:
         yield conn
-    finally:
-        conn.close()
 
 def execute_query(query: str, params: tuple = ()):
     """
@@ -41,4 +49,4 @@ def execute_update(query: str, params: tuple = ()):
         with conn.cursor() as cur:
             cur.execute(query, params)
             conn.commit()
-            return cur.rowcount
\ No newline at end of file
+            return cur.rowcount
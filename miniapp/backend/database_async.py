@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Асинхронный доступ к PostgreSQL для FastAPI-обработчиков.
+Запросы не блокируют event loop uvicorn.
+"""
+import logging
+from contextlib import asynccontextmanager
+from psycopg import AsyncConnection
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+
+from database import POSTGRES_DSN, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT
+
+logger = logging.getLogger("database_async")
+
+# Пул создаётся в lifespan приложения (см. open_async_pool / close_async_pool)
+async_pool: AsyncConnectionPool = None
+
+
+async def open_async_pool() -> AsyncConnectionPool:
+    """
+    Создать и открыть асинхронный пул соединений.
+    Должен вызываться внутри работающего event loop.
+    """
+    global async_pool
+    if async_pool is None:
+        async_pool = AsyncConnectionPool(
+            POSTGRES_DSN,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            timeout=DB_POOL_TIMEOUT,
+            kwargs={"row_factory": dict_row},
+            open=False
+        )
+        await async_pool.open()
+        logger.info(
+            f"Async DB pool opened (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE}, timeout={DB_POOL_TIMEOUT}s)"
+        )
+    return async_pool
+
+
+async def close_async_pool():
+    """Закрыть асинхронный пул (при остановке приложения)"""
+    global async_pool
+    if async_pool is not None:
+        await async_pool.close()
+        async_pool = None
+        logger.info("Async DB pool closed")
+
+
+@asynccontextmanager
+async def get_async_db():
+    """
+    Асинхронный контекстный менеджер для работы с БД.
+    При успешном выходе транзакция коммитится, при исключении - откатывается.
+    """
+    if async_pool is not None:
+        async with async_pool.connection() as conn:
+            yield conn
+        return
+
+    async with await AsyncConnection.connect(POSTGRES_DSN, row_factory=dict_row) as conn:
+        yield conn
+
+
+async def execute_query_async(query: str, params: tuple = ()):
+    """
+    Выполнить SELECT запрос (или запрос с RETURNING) и вернуть результаты
+    """
+    async with get_async_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(query, params)
+            return await cur.fetchall()
+
+
+async def execute_update_async(query: str, params: tuple = ()):
+    """
+    Выполнить INSERT/UPDATE/DELETE запрос
+    """
+    async with get_async_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(query, params)
+            await conn.commit()
+            return cur.rowcount
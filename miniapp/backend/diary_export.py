@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Потоковая выгрузка истории пользователя (приёмы пищи, вес, достижения)
+в NDJSON или CSV. Строки читаются серверным (именованным) курсором порциями,
+поэтому память не зависит от объёма истории.
+
+Выгрузка идёт столько, сколько клиент читает ответ, поэтому она берёт
+отдельное соединение вне пула (пул остаётся запросам API), а число
+одновременных выгрузок ограничено EXPORT_MAX_CONCURRENT.
+"""
+import os
+import csv
+import asyncio
+import io
+import json
+from datetime import datetime, date
+from typing import AsyncIterator, Optional
+
+from database_async import AsyncConnection, POSTGRES_DSN, dict_row
+
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", "500"))
+EXPORT_MAX_CONCURRENT = int(os.getenv("EXPORT_MAX_CONCURRENT", "4"))
+
+_export_slots = asyncio.Semaphore(EXPORT_MAX_CONCURRENT)
+
+CSV_COLUMNS = ["type", "ts", "local_day", "text", "calories", "proteins", "fats", "carbs", "weight", "badge"]
+
+_PERIOD = "ts >= COALESCE(%(since)s::timestamptz, '-infinity') AND ts < COALESCE(%(until)s::timestamptz, 'infinity')"
+
+EXPORT_QUERIES = [
+    ("meal", f"""
+        SELECT ts, local_day, text, calories, proteins, fats, carbs
+        FROM meals
+        WHERE user_id = %(user_id)s AND {_PERIOD}
+        ORDER BY ts
+    """),
+    ("weight", f"""
+        SELECT ts, weight
+        FROM weight_tracking
+        WHERE user_id = %(user_id)s AND {_PERIOD}
+        ORDER BY ts
+    """),
+    ("achievement", f"""
+        SELECT ts, badge
+        FROM achievements
+        WHERE user_id = %(user_id)s AND {_PERIOD}
+        ORDER BY ts
+    """),
+]
+
+
+def _plain(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+async def _records(user_id: int, since: Optional[datetime], until: Optional[datetime]) -> AsyncIterator[dict]:
+    params = {"user_id": user_id, "since": since, "until": until}
+    async with _export_slots:
+        async with await AsyncConnection.connect(POSTGRES_DSN, row_factory=dict_row) as conn:
+            for kind, query in EXPORT_QUERIES:
+                async with conn.cursor(name=f"export_{kind}") as cur:
+                    cur.itersize = EXPORT_FETCH_SIZE
+                    await cur.execute(query, params)
+                    async for row in cur:
+                        yield {"type": kind, **{k: _plain(v) for k, v in row.items()}}
+
+
+async def export_ndjson(user_id: int, since: Optional[datetime], until: Optional[datetime]) -> AsyncIterator[str]:
+    """Одна JSON-запись на строку"""
+    async for record in _records(user_id, since, until):
+        yield json.dumps(record, ensure_ascii=False) + "\n"
+
+
+async def export_csv(user_id: int, since: Optional[datetime], until: Optional[datetime]) -> AsyncIterator[str]:
+    """CSV с общим набором колонок для всех типов записей"""
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=CSV_COLUMNS, extrasaction="ignore")
+    writer.writeheader()
+    yield buf.getvalue()
+
+    async for record in _records(user_id, since, until):
+        buf.seek(0)
+        buf.truncate()
+        writer.writerow(record)
+        yield buf.getvalue()
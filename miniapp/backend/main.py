@@ -25,31 +25,51 @@ from bot_functions import (
     try_estimate_meal_from_db,  # Добавьте
     has_access,                  # Добавьте
     get_labs_credits,            # Добавьте
-    consume_labs_credit,         # Добавьте
+    charge_labs_credit,
+    refund_labs_credit,
     init_challenge,              # Добавьте
     update_challenge_progress,   # Добавьте
     get_challenge_name           # Добавьте
 )
-from fastapi import FastAPI, HTTPException, Depends, Query
+from fastapi import FastAPI, HTTPException, Depends, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 import os
+import csv
+import json
+import base64
 import logging
 from datetime import datetime, timezone, timedelta
 from typing import Optional, List
+from zoneinfo import ZoneInfo
 import asyncio
+from contextlib import asynccontextmanager
 
 # Наши модули
 # Наши модули
-from database import execute_query, execute_update, get_db
+from database_async import (
+    execute_query_async, execute_update_async, get_async_db,
+    open_async_pool, close_async_pool
+)
 from auth import get_current_user
 from models import (
     UserProfile, MealEntry, MealResponse, DiaryPeriod, DiaryDay,
     WeeklyStats, WeightEntry, WeightHistory, NutritionPlanRequest,
     ChallengeProgress, ChallengeList, LabsAnalysis, RecipeRequest,
-    Achievement
+    Achievement, TimezoneUpdate, MealImportResult, MealHistoryPage
 )
-from bot_functions import ai_chat, parse_meal_json, AI_AVAILABLE
+from bot_functions import ai_chat, ai_chat_stream, parse_meal_json, AI_AVAILABLE, AIUnavailableError
+from product_catalog import catalog
+from meal_cache import meal_cache
+from meal_batcher import meal_batcher
+from achievements import achievement_engine
+from task_queue import background_queue
+from daily_totals import daily_totals
+from plan_cache import plan_cache, plan_cache_key
+from ai_scheduler import ai_scheduler, AIQueueFull, PRIORITY_CHAT, PRIORITY_PLAN
+from model_health import model_health
+from meal_import import parse_import
+from diary_export import export_ndjson, export_csv
 
 
 # Настройка логирования
@@ -59,11 +79,49 @@ logging.basicConfig(
 )
 logger = logging.getLogger("miniapp")
 
+# Период недельных обзоров (дней, включая сегодня)
+WEEK_DAYS = 7
+
+# Размер страницы истории приёмов пищи
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "30"))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "100"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup
+    logger.info("🚀 NutriCoach Mini App Backend started")
+    logger.info(f"AI Available: {AI_AVAILABLE}")
+    
+    await open_async_pool()
+    try:
+        async with get_async_db() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT 1")
+        logger.info("✅ Database connection OK")
+    except Exception as e:
+        logger.error(f"❌ Database connection failed: {e}")
+    
+    try:
+        await catalog.refresh()
+    except Exception as e:
+        logger.error(f"❌ Product catalog load failed: {e}")
+    catalog_task = asyncio.create_task(catalog.run_refresh_loop())
+    await background_queue.start()
+    
+    yield
+    
+    # Shutdown
+    logger.info("👋 Shutting down...")
+    catalog_task.cancel()
+    await background_queue.stop()
+    await close_async_pool()
+
 # Создаём приложение
 app = FastAPI(
     title="NutriCoach Mini App API",
     description="Backend для Telegram Mini App бота-нутрициолога",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan
 )
 
 # CORS - разрешаем запросы с фронтенда
@@ -94,10 +152,10 @@ async def health_check():
     """Детальная проверка здоровья сервиса"""
     try:
         # Проверяем БД
-        with get_db() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT 1")
-                cur.fetchone()
+        async with get_async_db() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT 1")
+                await cur.fetchone()
         db_status = "ok"
     except Exception as e:
         db_status = f"error: {str(e)}"
@@ -108,6 +166,19 @@ async def health_check():
         "timestamp": datetime.now(timezone.utc).isoformat()
     }
 
+@app.get("/metrics")
+async def metrics():
+    """Внутренние счётчики сервиса (кэши, фоновая очередь)"""
+    return {
+        "meal_cache": meal_cache.stats(),
+        "meal_batcher": meal_batcher.stats(),
+        "background_queue": background_queue.stats(),
+        "daily_totals": daily_totals.stats(),
+        "plan_cache": plan_cache.stats(),
+        "ai_scheduler": ai_scheduler.stats(),
+        "ai_models": model_health.stats()
+    }
+
 # ==================== USER PROFILE ====================
 
 @app.get("/api/user/profile", response_model=UserProfile)
@@ -124,46 +195,47 @@ async def get_user_profile(user = Depends(get_current_user)):
     user_id = user['user_id']
     
     try:
-        # Получаем подписку
-        sub = execute_query(
-            "SELECT expires_at, free_until FROM subscriptions WHERE user_id = %s",
-            (user_id,)
-        )
-        
-        # Получаем кредиты
-        credits = execute_query(
-            "SELECT labs_credits FROM credits WHERE user_id = %s",
-            (user_id,)
-        )
-        
-        # Получаем достижения
-        achievements = execute_query(
-            "SELECT COUNT(*) as count FROM achievements WHERE user_id = %s",
-            (user_id,)
-        )
-        
-        # Получаем активные челленджи
-        challenges = execute_query(
-            "SELECT COUNT(*) as count FROM challenges WHERE user_id = %s AND completed = 0",
+        # Подписка, кредиты и счётчики - одним запросом.
+        # Счётчики берутся из user_counters (обновляется триггерами),
+        # если строки ещё нет - считаются подзапросами.
+        rows = await execute_query_async(
+            """
+            SELECT s.expires_at,
+                   s.free_until,
+                   COALESCE(s.tz, 'UTC') AS tz,
+                   COALESCE(c.labs_credits, 0) AS labs_credits,
+                   COALESCE(
+                       uc.achievements_count,
+                       (SELECT COUNT(*) FROM achievements a WHERE a.user_id = u.user_id)
+                   ) AS achievements_count,
+                   COALESCE(
+                       uc.active_challenges,
+                       (SELECT COUNT(*) FROM challenges ch WHERE ch.user_id = u.user_id AND ch.completed = 0)
+                   ) AS active_challenges
+            FROM (SELECT %s::bigint AS user_id) u
+            LEFT JOIN subscriptions s ON s.user_id = u.user_id
+            LEFT JOIN credits c ON c.user_id = u.user_id
+            LEFT JOIN user_counters uc ON uc.user_id = u.user_id
+            """,
             (user_id,)
         )
+        profile = rows[0]
         
         # Определяем статус подписки
         subscription_status = "expired"
         expires_at = None
         free_until = None
         
-        if sub and len(sub) > 0:
-            now = datetime.now(timezone.utc)
-            exp = sub[0].get('expires_at')
-            free = sub[0].get('free_until')
-            
-            if exp and exp > now:
-                subscription_status = "active"
-                expires_at = exp
-            elif free and free > now:
-                subscription_status = "trial"
-                free_until = free
+        now = datetime.now(timezone.utc)
+        exp = profile['expires_at']
+        free = profile['free_until']
+        
+        if exp and exp > now:
+            subscription_status = "active"
+            expires_at = exp
+        elif free and free > now:
+            subscription_status = "trial"
+            free_until = free
         
         return UserProfile(
             user_id=user_id,
@@ -171,15 +243,55 @@ async def get_user_profile(user = Depends(get_current_user)):
             subscription_status=subscription_status,
             expires_at=expires_at,
             free_until=free_until,
-            labs_credits=credits[0]['labs_credits'] if credits else 0,
-            achievements_count=achievements[0]['count'] if achievements else 0,
-            active_challenges=challenges[0]['count'] if challenges else 0
+            labs_credits=profile['labs_credits'],
+            achievements_count=profile['achievements_count'],
+            active_challenges=profile['active_challenges'],
+            timezone=profile['tz']
         )
         
     except Exception as e:
         logger.exception(f"Error getting profile for user {user_id}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/user/timezone")
+async def set_user_timezone(
+    update: TimezoneUpdate,
+    user = Depends(get_current_user)
+):
+    """
+    Сохранить часовой пояс пользователя (IANA, например Asia/Novosibirsk).
+    Влияет на границы дня для новых записей и на «сегодня»/«неделю».
+    """
+    user_id = user['user_id']
+    
+    try:
+        # Пояс применяется в SQL (AT TIME ZONE u.tz): база tz сервера PostgreSQL
+        # может не знать имя, которое принял Python - иначе все записи упадут с 500
+        known = await execute_query_async(
+            "SELECT 1 FROM pg_timezone_names WHERE name = %s",
+            (update.timezone,)
+        )
+        if not known:
+            raise HTTPException(status_code=422, detail="Unknown timezone")
+        
+        updated = await execute_update_async(
+            "UPDATE subscriptions SET tz = %s WHERE user_id = %s",
+            (update.timezone, user_id)
+        )
+        if not updated:
+            raise HTTPException(status_code=404, detail="User not found")
+        
+        daily_totals.invalidate(user_id)
+        achievement_engine.forget(user_id)
+        
+        return {"success": True, "timezone": update.timezone}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"Error setting timezone for user {user_id}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 # ==================== DIARY / TRACKER ====================
 
 @app.post("/api/diary/add", response_model=MealResponse)
@@ -192,7 +304,7 @@ async def add_meal_entry(
     
     Шаги:
     1. Пытаемся найти продукты в БД
-    2. Если не находим - используем AI
+    2. Если не находим - берём из кэша оценок или используем AI
     3. Сохраняем в БД
     4. Проверяем достижения
     """
@@ -206,8 +318,16 @@ async def add_meal_entry(
         if AI_AVAILABLE:
             db_result = try_estimate_meal_from_db(meal.text)
         
+        cached = None
+        if not db_result:
+            cached = await meal_cache.get(meal.text)
+        
         if db_result:
             calories, proteins, fats, carbs, summary = db_result
+        elif cached:
+            # Такой текст уже оценивался AI
+            source = "cache"
+            calories, proteins, fats, carbs, summary = cached
         else:
             # Шаг 2: Используем AI
             if not AI_AVAILABLE:
@@ -217,24 +337,11 @@ async def add_meal_entry(
                 )
             
             source = "ai"
-            system = 'Ты нутрициолог. Верни ТОЛЬКО JSON: {"calories": int, "proteins": float, "fats": float, "carbs": float, "summary": "text"}'
-            prompt = f'Оцени приём пищи и верни JSON в формате, например:\n{{"calories": 450, "proteins": 25.5, "fats": 12.0, "carbs": 50.0, "summary": "кратко"}}\n\nТекст: {meal.text}'
-            
             try:
-                response = await ai_chat(system, prompt, 0.2)
-                # Парсим JSON из ответа AI
-                import json
-                import re
-                match = re.search(r'\{.*\}', response, flags=re.S)
-                if match:
-                    data = json.loads(match.group(0))
-                    calories = int(data.get('calories', 0))
-                    proteins = float(data.get('proteins', 0.0))
-                    fats = float(data.get('fats', 0.0))
-                    carbs = float(data.get('carbs', 0.0))
-                    summary = str(data.get('summary', meal.text))
-                else:
-                    raise ValueError("No JSON in AI response")
+                calories, proteins, fats, carbs, summary = await meal_batcher.estimate(meal.text, user_id)
+                await meal_cache.put(meal.text, (calories, proteins, fats, carbs, summary))
+            except AIQueueFull:
+                raise HTTPException(status_code=429, detail="AI queue is full, try again later")
             except Exception as e:
                 logger.warning(f"AI meal parsing error: {e}")
                 # Fallback значения
@@ -245,19 +352,51 @@ async def add_meal_entry(
         # Шаг 3: Сохраняем в БД
         now = datetime.now(timezone.utc)
         
-        result = execute_query(
+        # Приём пищи и дневные итоги - одним запросом (одна транзакция).
+        # local_day - день в часовом поясе пользователя, считается при записи.
+        result = await execute_query_async(
             """
-            INSERT INTO meals (user_id, ts, text, calories, proteins, fats, carbs)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
+            WITH u AS (
+                SELECT COALESCE(
+                    (SELECT tz FROM subscriptions WHERE user_id = %(user_id)s), 'UTC'
+                ) AS tz
+            ), m AS (
+                INSERT INTO meals (user_id, ts, local_day, text, calories, proteins, fats, carbs)
+                SELECT %(user_id)s, %(ts)s, (%(ts)s::timestamptz AT TIME ZONE u.tz)::date,
+                       %(text)s, %(calories)s, %(proteins)s, %(fats)s, %(carbs)s
+                FROM u
+                RETURNING id, user_id, local_day, calories, proteins, fats, carbs
+            ), totals AS (
+                INSERT INTO meal_daily_totals AS t
+                    (user_id, local_date, meal_count, calories, proteins, fats, carbs)
+                SELECT user_id, local_day, 1,
+                       COALESCE(calories, 0), COALESCE(proteins, 0),
+                       COALESCE(fats, 0), COALESCE(carbs, 0)
+                FROM m
+                ON CONFLICT (user_id, local_date) DO UPDATE SET
+                    meal_count = t.meal_count + EXCLUDED.meal_count,
+                    calories = t.calories + EXCLUDED.calories,
+                    proteins = t.proteins + EXCLUDED.proteins,
+                    fats = t.fats + EXCLUDED.fats,
+                    carbs = t.carbs + EXCLUDED.carbs
+            )
+            SELECT m.id, m.local_day, u.tz FROM m, u
             """,
-            (user_id, now, meal.text, calories, proteins, fats, carbs)
+            {
+                'user_id': user_id, 'ts': now, 'text': meal.text,
+                'calories': calories, 'proteins': proteins, 'fats': fats, 'carbs': carbs
+            }
         )
         
-        meal_id = result[0]['id'] if result else None
+        meal_id = result[0]['id']
+        local_now = now.astimezone(ZoneInfo(result[0]['tz']))
+        daily_totals.add_meal(user_id, result[0]['local_day'], {
+            'calories': calories, 'proteins': proteins, 'fats': fats, 'carbs': carbs
+        })
         
-        # Шаг 4: Проверяем достижения (асинхронно)
-        asyncio.create_task(check_achievements_after_meal(user_id))
+        # Шаг 4: Проверяем достижения (в фоновой очереди, задачи одного пользователя схлопываются)
+        achievement_engine.record_meal(user_id, meal_id, local_now, meal.text)
+        background_queue.submit(("achievements", user_id), achievement_engine.process, user_id)
         
         return MealResponse(
             success=True,
@@ -270,74 +409,127 @@ async def add_meal_entry(
             source=source
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception(f"Error adding meal for user {user_id}")
         raise HTTPException(status_code=500, detail=str(e))
 
-async def check_achievements_after_meal(user_id: int):
-    """Проверка достижений после добавления еды (фоновая задача)"""
+@app.post("/api/diary/import", response_model=MealImportResult)
+async def import_meals(
+    request: Request,
+    format: str = Query("csv", pattern="^(csv|jsonl)$"),
+    user = Depends(get_current_user)
+):
+    """
+    Массовый импорт приёмов пищи (тело запроса - CSV с заголовком или JSON Lines)
+    
+    Поля: text, ts, calories, proteins, fats, carbs.
+    Строки без калорийности оцениваются по справочнику продуктов.
+    Все корректные строки загружаются одним COPY, дневные итоги
+    обновляются в той же транзакции.
+    """
+    user_id = user['user_id']
+    
     try:
-        # Логика из бота - award_achievements_after_meal
+        body = (await request.body()).decode('utf-8-sig')
         now = datetime.now(timezone.utc)
-        week_ago = (now - timedelta(days=7)).isoformat()
-        
-        meals = execute_query(
-            "SELECT ts, text FROM meals WHERE user_id = %s AND ts >= %s ORDER BY ts",
-            (user_id, week_ago)
-        )
         
-        breakfast_days = set()
-        has_water = False
-        has_sugar = False
-        
-        for meal in meals:
-            text_lower = (meal['text'] or '').lower()
-            hour = meal['ts'].hour if hasattr(meal['ts'], 'hour') else None
-            
-            if hour and 5 <= hour < 10:
-                breakfast_days.add(meal['ts'].date().isoformat())
-            
-            if 'вода' in text_lower:
-                has_water = True
+        try:
+            rows, results = parse_import(body, format, now)
+        except (ValueError, csv.Error) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        if rows:
+            async with get_async_db() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(
+                        "SELECT COALESCE((SELECT tz FROM subscriptions WHERE user_id = %s), 'UTC') AS tz",
+                        (user_id,)
+                    )
+                    tz = ZoneInfo((await cur.fetchone())['tz'])
+                    
+                    totals = {}
+                    async with cur.copy(
+                        "COPY meals (user_id, ts, local_day, text, calories, proteins, fats, carbs) FROM STDIN"
+                    ) as copy:
+                        for row in rows:
+                            ts = row['ts'] if row['ts'].tzinfo else row['ts'].replace(tzinfo=tz)
+                            local_day = ts.astimezone(tz).date()
+                            await copy.write_row((
+                                user_id, ts, local_day, row['text'],
+                                row['calories'], row['proteins'], row['fats'], row['carbs']
+                            ))
+                            
+                            day = totals.setdefault(local_day, [0, 0, 0.0, 0.0, 0.0])
+                            day[0] += 1
+                            day[1] += row['calories']
+                            day[2] += row['proteins']
+                            day[3] += row['fats']
+                            day[4] += row['carbs']
+                    
+                    await cur.executemany(
+                        """
+                        INSERT INTO meal_daily_totals AS t
+                            (user_id, local_date, meal_count, calories, proteins, fats, carbs)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s)
+                        ON CONFLICT (user_id, local_date) DO UPDATE SET
+                            meal_count = t.meal_count + EXCLUDED.meal_count,
+                            calories = t.calories + EXCLUDED.calories,
+                            proteins = t.proteins + EXCLUDED.proteins,
+                            fats = t.fats + EXCLUDED.fats,
+                            carbs = t.carbs + EXCLUDED.carbs
+                        """,
+                        [(user_id, day, *values) for day, values in totals.items()]
+                    )
             
-            if any(word in text_lower for word in ['сахар', 'торт', 'шоколад', 'печенье', 'конфет']):
-                has_sugar = True
-        
-        # Выдаём достижения
-        if len(breakfast_days) >= 7:
-            execute_update(
-                """
-                INSERT INTO achievements (user_id, badge, ts)
-                VALUES (%s, %s, %s)
-                ON CONFLICT DO NOTHING
-                """,
-                (user_id, "Завтрак-герой", now)
-            )
-        
-        if has_water:
-            execute_update(
-                """
-                INSERT INTO achievements (user_id, badge, ts)
-                VALUES (%s, %s, %s)
-                ON CONFLICT DO NOTHING
-                """,
-                (user_id, "Повелитель воды", now)
-            )
+            daily_totals.invalidate(user_id)
+            achievement_engine.forget(user_id)
         
-        if not has_sugar and len(meals) >= 21:  # 3 приёма * 7 дней
-            execute_update(
-                """
-                INSERT INTO achievements (user_id, badge, ts)
-                VALUES (%s, %s, %s)
-                ON CONFLICT DO NOTHING
-                """,
-                (user_id, "7 дней без сахара", now)
-            )
-        
-        logger.info(f"Achievements checked for user {user_id}")
+        return MealImportResult(
+            imported=len(rows),
+            failed=len(results) - len(rows),
+            rows=results
+        )
         
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.exception(f"Error checking achievements for user {user_id}: {e}")
+        logger.exception(f"Error importing meals for user {user_id}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/diary/export")
+async def export_diary(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    since: Optional[datetime] = Query(None),
+    until: Optional[datetime] = Query(None),
+    user = Depends(get_current_user)
+):
+    """
+    Выгрузка всей истории: приёмы пищи, вес, достижения
+    
+    Ответ отдаётся потоком (NDJSON или CSV), since/until ограничивают
+    период по времени записи - для инкрементальных выгрузок.
+    """
+    user_id = user['user_id']
+    
+    if since and since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    if until and until.tzinfo is None:
+        until = until.replace(tzinfo=timezone.utc)
+    
+    if format == "csv":
+        body = export_csv(user_id, since, until)
+        media_type = "text/csv; charset=utf-8"
+    else:
+        body = export_ndjson(user_id, since, until)
+        media_type = "application/x-ndjson"
+    
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="nutricoach_{user_id}.{format}"'}
+    )
 
 @app.get("/api/diary/today", response_model=DiaryDay)
 async def get_today_diary(user = Depends(get_current_user)):
@@ -345,27 +537,39 @@ async def get_today_diary(user = Depends(get_current_user)):
     user_id = user['user_id']
     
     try:
-        now = datetime.now(timezone.utc)
-        start_of_day = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        end_of_day = start_of_day + timedelta(days=1)
-        
-        meals = execute_query(
+        # «Сегодня» - в часовом поясе пользователя, выборка по индексу (user_id, local_day)
+        rows = await execute_query_async(
             """
-            SELECT id, ts, text, calories, proteins, fats, carbs
-            FROM meals
-            WHERE user_id = %s AND ts >= %s AND ts < %s
-            ORDER BY ts DESC
+            WITH u AS (
+                SELECT tz, (now() AT TIME ZONE tz)::date AS today
+                FROM (
+                    SELECT COALESCE(
+                        (SELECT tz FROM subscriptions WHERE user_id = %(user_id)s), 'UTC'
+                    ) AS tz
+                ) s
+            )
+            SELECT u.tz, u.today,
+                   m.id, m.ts, m.text, m.calories, m.proteins, m.fats, m.carbs
+            FROM u
+            LEFT JOIN meals m
+                   ON m.user_id = %(user_id)s
+                  AND m.local_day = u.today
+            ORDER BY m.ts DESC
             """,
-            (user_id, start_of_day, end_of_day)
+            {'user_id': user_id}
         )
         
+        tz = ZoneInfo(rows[0]['tz'])
+        today = rows[0]['today']
+        meals = [m for m in rows if m['id'] is not None]
+        
         total_cals = sum(m['calories'] or 0 for m in meals)
         total_p = sum(m['proteins'] or 0 for m in meals)
         total_f = sum(m['fats'] or 0 for m in meals)
         total_c = sum(m['carbs'] or 0 for m in meals)
         
         return DiaryDay(
-            date=now.date().isoformat(),
+            date=today.isoformat(),
             total_calories=total_cals,
             total_proteins=round(total_p, 1),
             total_fats=round(total_f, 1),
@@ -373,7 +577,7 @@ async def get_today_diary(user = Depends(get_current_user)):
             meals=[
                 {
                     'id': m['id'],
-                    'time': m['ts'].strftime('%H:%M'),
+                    'time': m['ts'].astimezone(tz).strftime('%H:%M'),
                     'text': m['text'],
                     'calories': m['calories'],
                     'proteins': m['proteins'],
@@ -394,37 +598,21 @@ async def get_week_diary(user = Depends(get_current_user)):
     user_id = user['user_id']
     
     try:
-        now = datetime.now(timezone.utc)
-        week_ago = now - timedelta(days=7)
-        
-        meals = execute_query(
-            """
-            SELECT DATE(ts) as day, 
-                   SUM(calories) as total_calories,
-                   SUM(proteins) as total_proteins,
-                   SUM(fats) as total_fats,
-                   SUM(carbs) as total_carbs
-            FROM meals
-            WHERE user_id = %s AND ts >= %s
-            GROUP BY DATE(ts)
-            ORDER BY day DESC
-            """,
-            (user_id, week_ago)
-        )
+        meals = await daily_totals.get_days(user_id, WEEK_DAYS)
         
         days = []
         total_cals = 0
         
-        for meal_day in meals:
-            day_cals = int(meal_day['total_calories'] or 0)
+        for meal_day in reversed(meals):
+            day_cals = int(meal_day['calories'] or 0)
             total_cals += day_cals
             
             days.append(DiaryDay(
                 date=meal_day['day'].isoformat(),
                 total_calories=day_cals,
-                total_proteins=round(meal_day['total_proteins'] or 0, 1),
-                total_fats=round(meal_day['total_fats'] or 0, 1),
-                total_carbs=round(meal_day['total_carbs'] or 0, 1),
+                total_proteins=round(meal_day['proteins'] or 0, 1),
+                total_fats=round(meal_day['fats'] or 0, 1),
+                total_carbs=round(meal_day['carbs'] or 0, 1),
                 meals=[]  # Детали не нужны для недельного обзора
             ))
         
@@ -440,6 +628,78 @@ async def get_week_diary(user = Depends(get_current_user)):
         logger.exception(f"Error getting week diary for user {user_id}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def _encode_history_cursor(ts: datetime, meal_id: int) -> str:
+    raw = json.dumps([ts.isoformat(), meal_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _decode_history_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        ts, meal_id = json.loads(raw)
+        return datetime.fromisoformat(ts), int(meal_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@app.get("/api/diary/history", response_model=MealHistoryPage)
+async def get_meal_history(
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    user = Depends(get_current_user)
+):
+    """
+    История приёмов пищи, от новых к старым
+    
+    Keyset-пагинация по индексу (user_id, ts DESC): курсор хранит (ts, id)
+    последней записи страницы, поэтому любая страница стоит одинаково.
+    """
+    user_id = user['user_id']
+    
+    try:
+        params = {'user_id': user_id, 'limit': limit + 1}
+        after = ""
+        if cursor:
+            params['ts'], params['id'] = _decode_history_cursor(cursor)
+            after = "AND ts <= %(ts)s AND (ts < %(ts)s OR id < %(id)s)"
+        
+        rows = await execute_query_async(
+            f"""
+            SELECT id, ts, local_day, text, calories, proteins, fats, carbs
+            FROM meals
+            WHERE user_id = %(user_id)s {after}
+            ORDER BY ts DESC, id DESC
+            LIMIT %(limit)s
+            """,
+            params
+        )
+        
+        page = rows[:limit]
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = _encode_history_cursor(page[-1]['ts'], page[-1]['id'])
+        
+        return MealHistoryPage(
+            meals=[
+                {
+                    'id': m['id'],
+                    'timestamp': m['ts'].isoformat(),
+                    'date': m['local_day'].isoformat() if m['local_day'] else m['ts'].date().isoformat(),
+                    'text': m['text'],
+                    'calories': m['calories'],
+                    'proteins': m['proteins'],
+                    'fats': m['fats'],
+                    'carbs': m['carbs']
+                }
+                for m in page
+            ],
+            next_cursor=next_cursor
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"Error getting meal history for user {user_id}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.delete("/api/diary/meal/{meal_id}")
 async def delete_meal(
     meal_id: int,
@@ -449,19 +709,40 @@ async def delete_meal(
     user_id = user['user_id']
     
     try:
-        # Проверяем что еда принадлежит пользователю
-        meal = execute_query(
-            "SELECT id FROM meals WHERE id = %s AND user_id = %s",
+        # Удаляем только если еда принадлежит пользователю
+        # и в том же запросе вычитаем её из дневных итогов
+        deleted = await execute_query_async(
+            """
+            WITH d AS (
+                DELETE FROM meals
+                WHERE id = %s AND user_id = %s
+                RETURNING user_id, ts, local_day, calories, proteins, fats, carbs
+            ), totals AS (
+                UPDATE meal_daily_totals t SET
+                    meal_count = t.meal_count - 1,
+                    calories = t.calories - COALESCE(d.calories, 0),
+                    proteins = t.proteins - COALESCE(d.proteins, 0),
+                    fats = t.fats - COALESCE(d.fats, 0),
+                    carbs = t.carbs - COALESCE(d.carbs, 0)
+                FROM d
+                WHERE t.user_id = d.user_id
+                  AND t.local_date = COALESCE(d.local_day, (d.ts AT TIME ZONE 'UTC')::date)
+            )
+            SELECT COALESCE(local_day, (ts AT TIME ZONE 'UTC')::date) AS local_day,
+                   calories, proteins, fats, carbs
+            FROM d
+            """,
             (meal_id, user_id)
         )
         
-        if not meal:
+        if not deleted:
             raise HTTPException(status_code=404, detail="Meal not found")
         
-        execute_update(
-            "DELETE FROM meals WHERE id = %s",
-            (meal_id,)
-        )
+        meal = deleted[0]
+        daily_totals.remove_meal(user_id, meal['local_day'], meal)
+        
+        # Счётчики достижений пересчитаются из БД при следующем приёме пищи
+        achievement_engine.forget(user_id)
         
         return {"success": True, "message": "Meal deleted"}
         
@@ -481,23 +762,7 @@ async def get_weekly_stats(user = Depends(get_current_user)):
     user_id = user['user_id']
     
     try:
-        week_ago = datetime.now(timezone.utc) - timedelta(days=7)
-        
-        meals = execute_query(
-            """
-            SELECT DATE(ts) as day,
-                   COUNT(*) as meal_count,
-                   SUM(calories) as calories,
-                   SUM(proteins) as proteins,
-                   SUM(fats) as fats,
-                   SUM(carbs) as carbs
-            FROM meals
-            WHERE user_id = %s AND ts >= %s
-            GROUP BY DATE(ts)
-            ORDER BY day
-            """,
-            (user_id, week_ago)
-        )
+        meals = await daily_totals.get_days(user_id, WEEK_DAYS)
         
         if not meals:
             return WeeklyStats(
@@ -555,7 +820,7 @@ async def add_weight_entry(
     try:
         now = datetime.now(timezone.utc)
         
-        execute_update(
+        await execute_update_async(
             "INSERT INTO weight_tracking (user_id, weight, ts) VALUES (%s, %s, %s)",
             (user_id, entry.weight, now)
         )
@@ -580,7 +845,7 @@ async def get_weight_history(
     try:
         since = datetime.now(timezone.utc) - timedelta(days=days)
         
-        weights = execute_query(
+        weights = await execute_query_async(
             """
             SELECT weight, ts
             FROM weight_tracking
@@ -615,58 +880,96 @@ async def get_weight_history(
         logger.exception(f"Error getting weight history for user {user_id}")
         raise HTTPException(status_code=500, detail=str(e))
 
-# ==================== NUTRITION PLAN ====================
+# ==================== STREAMING ====================
 
-@app.post("/api/plan/generate")
-async def generate_nutrition_plan(
-    plan_request: NutritionPlanRequest,
-    user = Depends(get_current_user)
-):
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no"  # nginx не должен буферизовать поток
+}
+
+
+def _sse_event(data: dict, event: Optional[str] = None) -> str:
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def sse_response(chunks, meta: Optional[dict] = None, on_error=None) -> StreamingResponse:
     """
-    Генерация персонального плана питания
+    Ответ text/event-stream: событие meta (если задано), затем фрагменты
+    текста (data: {"text": ...}), в конце - событие done или error.
+    on_error - корутина-функция, вызываемая при ошибке генерации
+    (например, вернуть списанный кредит).
     """
-    user_id = user['user_id']
+    async def events():
+        if meta is not None:
+            yield _sse_event(meta, "meta")
+        try:
+            async for text in chunks:
+                yield _sse_event({"text": text})
+        except AIQueueFull:
+            if on_error is not None:
+                await on_error()
+            yield _sse_event({"error": "AI queue is full, try again later"}, "error")
+            return
+        except Exception:
+            logger.exception("AI stream failed")
+            if on_error is not None:
+                await on_error()
+            yield _sse_event({"error": "AI service unavailable"}, "error")
+            return
+        yield _sse_event({}, "done")
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+# ==================== NUTRITION PLAN ====================
+
+PLAN_SYSTEM_PROMPT = "Ты профессиональный нутрициолог и диетолог. Пиши структурированно."
+
+
+async def check_ai_access(user):
+    """AI доступен и у пользователя есть подписка"""
+    if not AI_AVAILABLE:
+        raise HTTPException(status_code=503, detail="AI service unavailable")
+    if not await has_access(user['user_id'], user.get('username')):
+        raise HTTPException(status_code=403, detail="Subscription required")
+
+
+def check_ai_queue():
+    """Быстрый отказ (429), если очередь к AI уже заполнена"""
+    try:
+        ai_scheduler.check_capacity()
+    except AIQueueFull:
+        raise HTTPException(status_code=429, detail="AI queue is full, try again later")
+
+
+def calculate_daily_calories(plan_request: NutritionPlanRequest) -> int:
+    """Расчёт калорий (формула Миффлина-Сан Жеора)"""
+    if plan_request.sex == 'male':
+        bmr = 10 * plan_request.weight + 6.25 * plan_request.height - 5 * plan_request.age + 5
+    else:
+        bmr = 10 * plan_request.weight + 6.25 * plan_request.height - 5 * plan_request.age - 161
     
-    # Проверяем доступ
-    if AI_AVAILABLE and not has_access(user_id, user.get('username')):
-        raise HTTPException(
-            status_code=403,
-            detail="Subscription required"
-        )
+    activity_multipliers = {
+        "Сидячий образ жизни": 1.2,
+        "Легкая активность": 1.375,
+        "Умеренная активность": 1.55,
+        "Высокая активность": 1.725,
+        "Экстремальная активность": 1.9
+    }
+    multiplier = activity_multipliers.get(plan_request.activity, 1.55)
     
-    if not AI_AVAILABLE:
-        raise HTTPException(
-            status_code=503,
-            detail="AI service unavailable"
-        )
+    goal_adjustments = {
+        "снижение веса": 0.85,
+        "поддержание": 1.0,
+        "набор": 1.15
+    }
+    adjustment = goal_adjustments.get(plan_request.goal.lower(), 1.0)
     
-    try:
-        # Расчёт калорий (формула Миффлина-Сан Жеора)
-        if plan_request.sex == 'male':
-            bmr = 10 * plan_request.weight + 6.25 * plan_request.height - 5 * plan_request.age + 5
-        else:
-            bmr = 10 * plan_request.weight + 6.25 * plan_request.height - 5 * plan_request.age - 161
-        
-        activity_multipliers = {
-            "Сидячий образ жизни": 1.2,
-            "Легкая активность": 1.375,
-            "Умеренная активность": 1.55,
-            "Высокая активность": 1.725,
-            "Экстремальная активность": 1.9
-        }
-        multiplier = activity_multipliers.get(plan_request.activity, 1.55)
-        
-        goal_adjustments = {
-            "снижение веса": 0.85,
-            "поддержание": 1.0,
-            "набор": 1.15
-        }
-        adjustment = goal_adjustments.get(plan_request.goal.lower(), 1.0)
-        
-        daily_calories = round(bmr * multiplier * adjustment)
-        
-        # Генерируем план через AI
-        prompt = f"""Составь 7-дневный персональный план питания (завтрак/обед/ужин/перекусы), 
+    return round(bmr * multiplier * adjustment)
+
+
+def build_plan_prompt(plan_request: NutritionPlanRequest, daily_calories: int) -> str:
+    return f"""Составь 7-дневный персональный план питания (завтрак/обед/ужин/перекусы), 
 ориентировочные граммовки и примерную калорийность в день. Пиши структурированно.
 
 Данные клиента:
@@ -679,23 +982,112 @@ async def generate_nutrition_plan(
 - Предпочтения: {plan_request.preferences}
 - Ограничения: {plan_request.restrictions}
 - Рекомендуемая калорийность: {daily_calories} ккал/день"""
+
+
+@app.post("/api/plan/generate")
+async def generate_nutrition_plan(
+    plan_request: NutritionPlanRequest,
+    regenerate: bool = Query(False, description="Не брать план из кэша"),
+    user = Depends(get_current_user)
+):
+    """
+    Генерация персонального плана питания.
+    Одинаковая анкета отдаётся из кэша, regenerate=true - сгенерировать заново.
+    """
+    user_id = user['user_id']
+    
+    await check_ai_access(user)
+    
+    try:
+        daily_calories = calculate_daily_calories(plan_request)
+        cache_key = plan_cache_key(plan_request, daily_calories)
+        
+        if regenerate:
+            plan_cache.bypassed += 1
+        else:
+            plan_text = await plan_cache.get(cache_key)
+            if plan_text is not None:
+                return {
+                    "success": True,
+                    "daily_calories": daily_calories,
+                    "plan": plan_text,
+                    "cached": True
+                }
         
         plan_text = await ai_chat(
-            "Ты профессиональный нутрициолог и диетолог. Пиши структурированно.",
-            prompt,
-            0.4
+            PLAN_SYSTEM_PROMPT,
+            build_plan_prompt(plan_request, daily_calories),
+            0.4,
+            strict=True,
+            user_id=user_id,
+            priority=PRIORITY_PLAN
         )
+        await plan_cache.put(cache_key, daily_calories, plan_text)
         
         return {
             "success": True,
             "daily_calories": daily_calories,
-            "plan": plan_text
+            "plan": plan_text,
+            "cached": False
         }
         
+    except AIQueueFull:
+        raise HTTPException(status_code=429, detail="AI queue is full, try again later")
+    except AIUnavailableError:
+        raise HTTPException(status_code=503, detail="AI service unavailable")
     except Exception as e:
         logger.exception(f"Error generating plan for user {user_id}")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def _stream_and_cache_plan(chunks, cache_key: str, daily_calories: int):
+    """Отдавать фрагменты плана и сохранить план в кэш, если поток дошёл до конца"""
+    parts = []
+    async for text in chunks:
+        parts.append(text)
+        yield text
+    await plan_cache.put(cache_key, daily_calories, "".join(parts))
+
+async def _single_chunk(text: str):
+    yield text
+
+@app.post("/api/plan/generate/stream")
+async def generate_nutrition_plan_stream(
+    plan_request: NutritionPlanRequest,
+    regenerate: bool = Query(False, description="Не брать план из кэша"),
+    user = Depends(get_current_user)
+):
+    """
+    Генерация плана питания потоком (SSE): сначала meta с daily_calories
+    и признаком cached, затем текст плана по мере генерации
+    """
+    await check_ai_access(user)
+    
+    daily_calories = calculate_daily_calories(plan_request)
+    cache_key = plan_cache_key(plan_request, daily_calories)
+    
+    if regenerate:
+        plan_cache.bypassed += 1
+    else:
+        plan_text = await plan_cache.get(cache_key)
+        if plan_text is not None:
+            return sse_response(
+                _single_chunk(plan_text),
+                meta={"daily_calories": daily_calories, "cached": True}
+            )
+    
+    check_ai_queue()
+    chunks = ai_chat_stream(
+        PLAN_SYSTEM_PROMPT,
+        build_plan_prompt(plan_request, daily_calories),
+        0.4,
+        user_id=user['user_id'],
+        priority=PRIORITY_PLAN
+    )
+    return sse_response(
+        _stream_and_cache_plan(chunks, cache_key, daily_calories),
+        meta={"daily_calories": daily_calories, "cached": False}
+    )
+
 # ==================== CHALLENGES ====================
 
 @app.get("/api/challenges/list", response_model=ChallengeList)
@@ -705,7 +1097,7 @@ async def get_challenges_list(user = Depends(get_current_user)):
     
     try:
         # Активные челленджи
-        active = execute_query(
+        active = await execute_query_async(
             """
             SELECT challenge_type, progress, completed
             FROM challenges
@@ -762,11 +1154,11 @@ async def start_challenge(
     
     try:
         if AI_AVAILABLE:
-            success = init_challenge(user_id, challenge_type)
+            success = await init_challenge(user_id, challenge_type)
         else:
             # Fallback без импорта функций
             now = datetime.now(timezone.utc)
-            execute_update(
+            await execute_update_async(
                 """
                 INSERT INTO challenges (user_id, challenge_type, start_date, progress, completed)
                 VALUES (%s, %s, %s, 0, 0)
@@ -794,67 +1186,7 @@ async def log_challenge_progress(
     user_id = user['user_id']
     
     try:
-        if AI_AVAILABLE:
-            updated = update_challenge_progress(user_id, challenge_type)
-        else:
-            # Fallback
-            today = datetime.now(timezone.utc).date().isoformat()
-            
-            # Проверяем не отмечено ли уже
-            existing = execute_query(
-                """
-                SELECT 1 FROM challenge_logs
-                WHERE user_id = %s AND challenge_type = %s AND log_date = %s
-                """,
-                (user_id, challenge_type, today)
-            )
-            
-            if existing:
-                return {"success": False, "message": "Already logged today"}
-            
-            # Добавляем лог
-            execute_update(
-                """
-                INSERT INTO challenge_logs (user_id, challenge_type, log_date, completed)
-                VALUES (%s, %s, %s, 1)
-                """,
-                (user_id, challenge_type, today)
-            )
-            
-            # Обновляем прогресс
-            execute_update(
-                """
-                UPDATE challenges
-                SET progress = progress + 1
-                WHERE user_id = %s AND challenge_type = %s
-                """,
-                (user_id, challenge_type)
-            )
-            
-            # Проверяем завершение
-            challenge = execute_query(
-                "SELECT progress FROM challenges WHERE user_id = %s AND challenge_type = %s",
-                (user_id, challenge_type)
-            )
-            
-            if challenge and challenge[0]['progress'] >= 7:
-                execute_update(
-                    "UPDATE challenges SET completed = 1 WHERE user_id = %s AND challenge_type = %s",
-                    (user_id, challenge_type)
-                )
-                
-                # Добавляем достижение
-                achievement_name = f"Челлендж: {challenge_type}"
-                execute_update(
-                    """
-                    INSERT INTO achievements (user_id, badge, ts)
-                    VALUES (%s, %s, %s)
-                    ON CONFLICT DO NOTHING
-                    """,
-                    (user_id, achievement_name, datetime.now(timezone.utc))
-                )
-            
-            updated = True
+        updated = await update_challenge_progress(user_id, challenge_type)
         
         if updated:
             return {"success": True, "message": "Progress logged"}
@@ -873,7 +1205,7 @@ async def get_achievements(user = Depends(get_current_user)):
     user_id = user['user_id']
     
     try:
-        achievements = execute_query(
+        achievements = await execute_query_async(
             """
             SELECT badge, ts
             FROM achievements
@@ -912,6 +1244,31 @@ def get_achievement_description(badge: str) -> str:
 
 # ==================== LABS ANALYSIS ====================
 
+LABS_SYSTEM_PROMPT = "Пиши кратко и структурированно."
+
+
+def build_labs_prompt(labs: LabsAnalysis) -> str:
+    return f"Ты нутрициолог. Проанализируй лабораторные анализы и дай практические рекомендации.\n\n{labs.text}"
+
+
+async def charge_labs_analysis(user) -> Optional[str]:
+    """
+    Списать бесплатную попытку или кредит (кроме админа).
+    Возвращает вид списания для refund_labs_credit (None - ничего не списано).
+    """
+    is_admin = user.get('username', '').lower() == os.getenv('ADMIN_USERNAME', '').lower()
+    if is_admin:
+        return None
+    
+    charge = await charge_labs_credit(user['user_id'])
+    if charge is None:
+        raise HTTPException(
+            status_code=402,
+            detail="No credits available"
+        )
+    return charge
+
+
 @app.post("/api/labs/analyze")
 async def analyze_labs(
     labs: LabsAnalysis,
@@ -922,49 +1279,22 @@ async def analyze_labs(
     """
     user_id = user['user_id']
     
-    # Проверяем кредиты (кроме админа)
     if not AI_AVAILABLE:
         raise HTTPException(status_code=503, detail="AI service unavailable")
     
-    is_admin = user.get('username', '').lower() == os.getenv('ADMIN_USERNAME', '').lower()
-    
-    if not is_admin:
-        # Проверяем бесплатную попытку
-        used_free = execute_query(
-            "SELECT used_free_lab FROM subscriptions WHERE user_id = %s",
-            (user_id,)
-        )
-        
-        if not used_free or not used_free[0].get('used_free_lab'):
-            # Активируем бесплатную
-            execute_update(
-                "UPDATE subscriptions SET used_free_lab = 1 WHERE user_id = %s",
-                (user_id,)
-            )
-        else:
-            # Проверяем кредиты
-            credits = get_labs_credits(user_id)
-            if credits <= 0:
-                raise HTTPException(
-                    status_code=402,
-                    detail="No credits available"
-                )
-            
-            # Списываем кредит
-            if not consume_labs_credit(user_id):
-                raise HTTPException(
-                    status_code=402,
-                    detail="Failed to consume credit"
-                )
+    # Не списываем кредит, если запрос всё равно не попадёт в очередь к AI
+    check_ai_queue()
+    charge = await charge_labs_analysis(user)
     
     try:
         # Анализируем через AI
-        prompt = f"Ты нутрициолог. Проанализируй лабораторные анализы и дай практические рекомендации.\n\n{labs.text}"
-        
         analysis = await ai_chat(
-            "Пиши кратко и структурированно.",
-            prompt,
-            0.3
+            LABS_SYSTEM_PROMPT,
+            build_labs_prompt(labs),
+            0.3,
+            strict=True,
+            user_id=user_id,
+            priority=PRIORITY_CHAT
         )
         
         return {
@@ -972,10 +1302,44 @@ async def analyze_labs(
             "analysis": analysis
         }
         
+    # Анализ не получен - возвращаем списанное
+    except AIQueueFull:
+        await refund_labs_credit(user_id, charge)
+        raise HTTPException(status_code=429, detail="AI queue is full, try again later")
+    except AIUnavailableError:
+        await refund_labs_credit(user_id, charge)
+        raise HTTPException(status_code=503, detail="AI service unavailable")
     except Exception as e:
+        await refund_labs_credit(user_id, charge)
         logger.exception(f"Error analyzing labs for user {user_id}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/labs/analyze/stream")
+async def analyze_labs_stream(
+    labs: LabsAnalysis,
+    user = Depends(get_current_user)
+):
+    """Анализ лабораторных данных потоком (SSE)"""
+    if not AI_AVAILABLE:
+        raise HTTPException(status_code=503, detail="AI service unavailable")
+    
+    check_ai_queue()
+    charge = await charge_labs_analysis(user)
+    
+    async def refund():
+        await refund_labs_credit(user['user_id'], charge)
+    
+    return sse_response(
+        ai_chat_stream(
+            LABS_SYSTEM_PROMPT,
+            build_labs_prompt(labs),
+            0.3,
+            user_id=user['user_id'],
+            priority=PRIORITY_CHAT
+        ),
+        on_error=refund
+    )
+
 @app.get("/api/labs/credits")
 async def get_labs_credits_count(user = Depends(get_current_user)):
     """Получить количество оставшихся кредитов на анализы"""
@@ -983,9 +1347,9 @@ async def get_labs_credits_count(user = Depends(get_current_user)):
     
     try:
         if AI_AVAILABLE:
-            credits = get_labs_credits(user_id)
+            credits = await get_labs_credits(user_id)
         else:
-            result = execute_query(
+            result = await execute_query_async(
                 "SELECT labs_credits FROM credits WHERE user_id = %s",
                 (user_id,)
             )
@@ -999,6 +1363,17 @@ async def get_labs_credits_count(user = Depends(get_current_user)):
 
 # ==================== RECIPES ====================
 
+RECIPE_SYSTEM_PROMPT = "Пиши структурированно, ясно."
+
+
+def build_recipe_prompt(recipe_request: RecipeRequest) -> str:
+    return f"""Ты шеф-повар и нутрициолог. На основе списка продуктов составь 3 рецепта. Для каждого: 
+название, ингредиенты с граммовками, шаги приготовления, калорийность и БЖУ на порцию.
+
+Продукты:
+{recipe_request.products}"""
+
+
 @app.post("/api/recipe/generate")
 async def generate_recipe(
     recipe_request: RecipeRequest,
@@ -1007,23 +1382,15 @@ async def generate_recipe(
     """Генерация рецептов из продуктов"""
     user_id = user['user_id']
     
-    if not AI_AVAILABLE:
-        raise HTTPException(status_code=503, detail="AI service unavailable")
-    
-    if not has_access(user_id, user.get('username')):
-        raise HTTPException(status_code=403, detail="Subscription required")
+    await check_ai_access(user)
     
     try:
-        prompt = f"""Ты шеф-повар и нутрициолог. На основе списка продуктов составь 3 рецепта. Для каждого: 
-название, ингредиенты с граммовками, шаги приготовления, калорийность и БЖУ на порцию.
-
-Продукты:
-{recipe_request.products}"""
-        
         recipes = await ai_chat(
-            "Пиши структурированно, ясно.",
-            prompt,
-            0.5
+            RECIPE_SYSTEM_PROMPT,
+            build_recipe_prompt(recipe_request),
+            0.5,
+            user_id=user_id,
+            priority=PRIORITY_CHAT
         )
         
         return {
@@ -1031,10 +1398,29 @@ async def generate_recipe(
             "recipes": recipes
         }
         
+    except AIQueueFull:
+        raise HTTPException(status_code=429, detail="AI queue is full, try again later")
     except Exception as e:
         logger.exception(f"Error generating recipes for user {user_id}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/recipe/generate/stream")
+async def generate_recipe_stream(
+    recipe_request: RecipeRequest,
+    user = Depends(get_current_user)
+):
+    """Генерация рецептов потоком (SSE)"""
+    await check_ai_access(user)
+    check_ai_queue()
+    
+    return sse_response(ai_chat_stream(
+        RECIPE_SYSTEM_PROMPT,
+        build_recipe_prompt(recipe_request),
+        0.5,
+        user_id=user['user_id'],
+        priority=PRIORITY_CHAT
+    ))
+
 # ==================== ERROR HANDLERS ====================
 
 @app.exception_handler(HTTPException)
@@ -1060,43 +1446,6 @@ async def general_exception_handler(request, exc):
         }
     )
 
-from contextlib import asynccontextmanager
-
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    # Startup
-    logger.info("🚀 NutriCoach Mini App Backend started")
-    logger.info(f"AI Available: {AI_AVAILABLE}")
-    
-    try:
-        with get_db() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT 1")
-        logger.info("✅ Database connection OK")
-    except Exception as e:
-        logger.error(f"❌ Database connection failed: {e}")
-    
-    yield
-    
-    # Shutdown
-    logger.info("👋 Shutting down...")
-
-# Обновите создание app:
-app = FastAPI(
-    title="NutriCoach Mini App API",
-    description="Backend для Telegram Mini App бота-нутрициолога",
-    version="2.0.0",
-    lifespan=lifespan  # Добавьте эту строку
-)
-@app.get("/")
-async def root():
-    """Проверка работоспособности API"""
-    return {
-        "service": "NutriCoach Mini App Backend",
-        "version": "2.0.0",
-        "status": "operational",
-        "ai_available": AI_AVAILABLE
-    }
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(
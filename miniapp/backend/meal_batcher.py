@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Пакетная оценка приёмов пищи через AI.
+
+Тексты, пришедшие в течение короткого окна (MEAL_BATCH_WINDOW_MS) или
+до набора MEAL_BATCH_MAX_ITEMS штук, отправляются одним запросом
+(ответ - JSON-массив), результаты раздаются ожидающим запросам.
+Одинаковые тексты внутри пакета оцениваются один раз. Приёмы, которых
+нет в JSON-ответе или не разобраны, оцениваются по одному; ошибка
+самого запроса (AI недоступен, очередь переполнена) передаётся всем.
+"""
+import os
+import asyncio
+import logging
+from typing import Dict, List, Optional, Set
+
+from meal_cache import MealEstimate, normalize_meal_text
+
+logger = logging.getLogger("meal_batcher")
+
+MEAL_BATCH_WINDOW_MS = int(os.getenv("MEAL_BATCH_WINDOW_MS", "100"))
+MEAL_BATCH_MAX_ITEMS = int(os.getenv("MEAL_BATCH_MAX_ITEMS", "10"))
+
+
+class _Pending:
+    __slots__ = ("text", "user_id", "future")
+
+    def __init__(self, text: str, user_id: Optional[int], future: asyncio.Future):
+        self.text = text
+        self.user_id = user_id
+        self.future = future
+
+
+class MealBatcher:
+    """Собирает тексты в пакеты и оценивает их одним запросом к AI"""
+
+    def __init__(self, window_ms: int = MEAL_BATCH_WINDOW_MS, max_items: int = MEAL_BATCH_MAX_ITEMS):
+        self.window = window_ms / 1000
+        self.max_items = max_items
+        self._pending: List[_Pending] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self.batches = 0
+        self.items = 0
+        self.singles = 0
+
+    async def estimate(self, meal_text: str, user_id: Optional[int] = None) -> MealEstimate:
+        """Оценка одного приёма; исключения - как у estimate_meal_with_ai"""
+        if self.window <= 0 or self.max_items <= 1:
+            return await self._estimate_single(meal_text, user_id)
+
+        loop = asyncio.get_running_loop()
+        item = _Pending(meal_text, user_id, loop.create_future())
+        self._pending.append(item)
+        if len(self._pending) >= self.max_items:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await item.future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _estimate_single(self, meal_text: str, user_id: Optional[int]) -> MealEstimate:
+        from bot_functions import estimate_meal_with_ai
+
+        self.singles += 1
+        return await estimate_meal_with_ai(meal_text, user_id)
+
+    async def _run(self, batch: List[_Pending]):
+        from bot_functions import estimate_meals_with_ai
+
+        # Ожидающие, сгруппированные по нормализованному тексту
+        groups: Dict[str, List[_Pending]] = {}
+        for item in batch:
+            if not item.future.done():
+                groups.setdefault(normalize_meal_text(item.text) or item.text, []).append(item)
+        if not groups:
+            return
+
+        keys = list(groups)
+        texts = [groups[key][0].text for key in keys]
+        results: List[Optional[MealEstimate]] = [None] * len(keys)
+        if len(keys) > 1:
+            self.batches += 1
+            self.items += len(keys)
+            try:
+                # Пакет встаёт в очередь AI от имени первого запросившего: иначе все
+                # пакеты шли бы одним «анонимным» пользователем мимо очереди по кругу
+                results = await estimate_meals_with_ai(texts, groups[keys[0]][0].user_id)
+            except Exception as e:
+                # Очередь переполнена, AI недоступен или ответ не JSON - ошибка общая
+                # для всех; поштучные повторы только умножили бы запросы к AI
+                logger.warning(f"Batch meal estimate failed ({len(keys)} items): {e}")
+                self._resolve_all(groups, e)
+                return
+
+        await asyncio.gather(*(
+            self._resolve(groups[key], results[n]) for n, key in enumerate(keys)
+        ))
+
+    async def _resolve(self, items: List[_Pending], result: Optional[MealEstimate]):
+        if result is None:
+            try:
+                result = await self._estimate_single(items[0].text, items[0].user_id)
+            except Exception as e:
+                self._resolve_all({"": items}, e)
+                return
+        for item in items:
+            if not item.future.done():
+                item.future.set_result(result)
+
+    @staticmethod
+    def _resolve_all(groups: Dict[str, List[_Pending]], error: Exception):
+        for items in groups.values():
+            for item in items:
+                if not item.future.done():
+                    item.future.set_exception(error)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "batches": self.batches,
+            "batched_items": self.items,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "single_requests": self.singles
+        }
+
+
+# Глобальный экземпляр
+meal_batcher = MealBatcher()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Кэш AI-оценок приёмов пищи.
+Два уровня: LRU в памяти процесса (с TTL) и таблица meal_estimate_cache в PostgreSQL.
+Одинаковые тексты («кофе с молоком») не отправляются в AI повторно.
+"""
+import os
+import re
+import time
+import logging
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+logger = logging.getLogger("meal_cache")
+
+MEAL_CACHE_SIZE = int(os.getenv("MEAL_CACHE_SIZE", "5000"))
+MEAL_CACHE_TTL = int(os.getenv("MEAL_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+
+MealEstimate = Tuple[int, float, float, float, str]
+
+
+def normalize_meal_text(text: str) -> str:
+    """Ключ кэша: регистр, ё→е, пробелы и пунктуация по краям"""
+    text = (text or "").lower().replace("ё", "е")
+    text = " ".join(text.split())
+    return re.sub(r"^[\s.,;!]+|[\s.,;!]+$", "", text)
+
+
+class MealEstimateCache:
+    """
+    Нормализованный текст → (calories, proteins, fats, carbs, summary).
+    Промах в памяти проверяется в БД, найденное в БД поднимается в память.
+    """
+
+    def __init__(self, max_size: int = MEAL_CACHE_SIZE, ttl: int = MEAL_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: "OrderedDict[str, Tuple[float, MealEstimate]]" = OrderedDict()
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def _remember(self, key: str, value: MealEstimate):
+        self._items[key] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    async def get(self, text: str) -> Optional[MealEstimate]:
+        """Найти оценку в памяти, затем в БД"""
+        key = normalize_meal_text(text)
+        if not key:
+            return None
+
+        item = self._items.get(key)
+        if item:
+            expires, value = item
+            if expires > time.monotonic():
+                self._items.move_to_end(key)
+                self.memory_hits += 1
+                return value
+            del self._items[key]
+
+        from database_async import execute_query_async
+
+        try:
+            rows = await execute_query_async(
+                """
+                SELECT calories, proteins, fats, carbs, summary
+                FROM meal_estimate_cache
+                WHERE text_key = %s AND created_at > now() - make_interval(secs => %s)
+                """,
+                (key, self.ttl)
+            )
+        except Exception as e:
+            logger.warning(f"Meal cache DB read failed: {e}")
+            rows = []
+
+        if rows:
+            row = rows[0]
+            value = (row["calories"], row["proteins"], row["fats"], row["carbs"], row["summary"])
+            self._remember(key, value)
+            self.db_hits += 1
+            return value
+
+        self.misses += 1
+        return None
+
+    async def put(self, text: str, value: MealEstimate):
+        """Сохранить оценку в память и в БД"""
+        key = normalize_meal_text(text)
+        if not key:
+            return
+        self._remember(key, value)
+
+        from database_async import execute_update_async
+
+        try:
+            await execute_update_async(
+                """
+                INSERT INTO meal_estimate_cache (text_key, calories, proteins, fats, carbs, summary, created_at)
+                VALUES (%s, %s, %s, %s, %s, %s, now())
+                ON CONFLICT (text_key) DO UPDATE SET
+                    calories = EXCLUDED.calories,
+                    proteins = EXCLUDED.proteins,
+                    fats = EXCLUDED.fats,
+                    carbs = EXCLUDED.carbs,
+                    summary = EXCLUDED.summary,
+                    created_at = EXCLUDED.created_at
+                """,
+                (key, *value)
+            )
+        except Exception as e:
+            logger.warning(f"Meal cache DB write failed: {e}")
+
+    def stats(self) -> dict:
+        """Счётчики попаданий/промахов"""
+        lookups = self.memory_hits + self.db_hits + self.misses
+        return {
+            "size": len(self._items),
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.memory_hits + self.db_hits) / lookups, 3) if lookups else 0.0
+        }
+
+
+# Глобальный экземпляр
+meal_cache = MealEstimateCache()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Разбор файлов массового импорта приёмов пищи (CSV или JSON Lines).
+
+Поля строки: text (обязательно), ts (ISO 8601, по умолчанию - сейчас),
+calories, proteins, fats, carbs. Если калорийность не указана - она
+оценивается по справочнику продуктов в памяти (без запросов к БД).
+"""
+import os
+import csv
+import math
+import json
+import io
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from bot_functions import try_estimate_meal_from_db
+
+IMPORT_MAX_ROWS = int(os.getenv("IMPORT_MAX_ROWS", "5000"))
+IMPORT_TEXT_MAX_LENGTH = 1000
+
+# Пределы типов столбцов meals: значение вне диапазона сорвало бы весь COPY
+INTEGER_MAX = 2147483647         # calories INTEGER
+REAL_MAX = 3.4028234663852886e38  # proteins/fats/carbs REAL (float4)
+
+
+def _read_records(body: str, fmt: str) -> List[dict]:
+    if fmt == "csv":
+        return list(csv.DictReader(io.StringIO(body)))
+
+    records = []
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            record = {"__error__": f"Invalid JSON: {e}"}
+        if not isinstance(record, dict):
+            record = {"__error__": "JSON object expected"}
+        records.append(record)
+    return records
+
+
+def _number(record: dict, field: str, cast, limit: float) -> Optional[float]:
+    value = record.get(field)
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    try:
+        number = cast(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f"Invalid {field}: {value!r}")
+    if not math.isfinite(number):
+        raise ValueError(f"Invalid {field}: {value!r}")
+    if number < 0:
+        raise ValueError(f"Negative {field}")
+    if number > limit:
+        raise ValueError(f"Too large {field}: {value!r}")
+    return number
+
+
+def _parse_record(record: dict, now: datetime) -> dict:
+    if "__error__" in record:
+        raise ValueError(record["__error__"])
+
+    text = str(record.get("text") or "").strip()
+    if not text:
+        raise ValueError("Empty text")
+    if len(text) > IMPORT_TEXT_MAX_LENGTH:
+        raise ValueError("Text too long")
+
+    ts_raw = record.get("ts")
+    if ts_raw:
+        try:
+            ts = datetime.fromisoformat(str(ts_raw).strip())
+        except ValueError:
+            raise ValueError(f"Invalid ts: {ts_raw!r}")
+    else:
+        ts = now
+
+    calories = _number(record, "calories", lambda v: int(float(v)), INTEGER_MAX)
+    if calories is not None:
+        return {
+            "ts": ts,
+            "text": text,
+            "calories": calories,
+            "proteins": _number(record, "proteins", float, REAL_MAX) or 0.0,
+            "fats": _number(record, "fats", float, REAL_MAX) or 0.0,
+            "carbs": _number(record, "carbs", float, REAL_MAX) or 0.0,
+            "source": "file"
+        }
+
+    estimate = try_estimate_meal_from_db(text)
+    if not estimate:
+        raise ValueError("No calories given and products not found in catalog")
+    calories, proteins, fats, carbs, _ = estimate
+    return {
+        "ts": ts,
+        "text": text,
+        "calories": calories,
+        "proteins": proteins,
+        "fats": fats,
+        "carbs": carbs,
+        "source": "database"
+    }
+
+
+def parse_import(body: str, fmt: str, now: datetime) -> Tuple[List[dict], List[dict]]:
+    """
+    Разобрать файл импорта.
+    Возвращает (строки для вставки, результаты по каждой строке файла).
+    Время без часового пояса (naive) остаётся naive - его локализует вызывающий код.
+    """
+    records = _read_records(body, fmt)
+    if len(records) > IMPORT_MAX_ROWS:
+        raise ValueError(f"Too many rows: {len(records)} > {IMPORT_MAX_ROWS}")
+
+    rows = []
+    results = []
+    for n, record in enumerate(records, start=1):
+        try:
+            row = _parse_record(record, now)
+        except ValueError as e:
+            results.append({"row": n, "status": "error", "error": str(e)})
+            continue
+        rows.append(row)
+        results.append({
+            "row": n,
+            "status": "ok",
+            "calories": row["calories"],
+            "source": row["source"]
+        })
+    return rows, results
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Здоровье AI-моделей и автоматический выключатель (circuit breaker).
+
+По каждой модели хранятся последние AI_HEALTH_WINDOW результатов (успех,
+задержка). Если доля ошибок в окне превышает порог, модель «размыкается»
+и не вызывается AI_BREAKER_COOLDOWN секунд; затем пропускается один
+пробный запрос (half-open): успех замыкает цепь, ошибка - снова размыкает.
+Запрос, отменённый без ответа (проиграл хеджирование), считается таймаутом:
+ошибкой с задержкой, равной времени ожидания.
+Порядок моделей в ai_chat строится по доле ошибок и задержке.
+"""
+import os
+import time
+import logging
+from collections import deque
+from typing import Dict, List
+
+logger = logging.getLogger("model_health")
+
+AI_HEALTH_WINDOW = int(os.getenv("AI_HEALTH_WINDOW", "20"))
+AI_BREAKER_MIN_SAMPLES = int(os.getenv("AI_BREAKER_MIN_SAMPLES", "5"))
+AI_BREAKER_ERROR_RATE = float(os.getenv("AI_BREAKER_ERROR_RATE", "0.5"))
+AI_BREAKER_COOLDOWN = float(os.getenv("AI_BREAKER_COOLDOWN_SECONDS", "30"))
+# Задержки внутри одной корзины считаются равными - порядок не «дрожит»
+AI_HEALTH_LATENCY_BUCKET = float(os.getenv("AI_HEALTH_LATENCY_BUCKET_SECONDS", "5"))
+# Отмена раньше этого срока не говорит о модели ничего (например, клиент ушёл сразу)
+AI_HEALTH_CANCEL_MIN_SECONDS = float(os.getenv("AI_HEALTH_CANCEL_MIN_SECONDS", "1"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class _ModelState:
+    __slots__ = ("results", "state", "opened_at", "probing")
+
+    def __init__(self, window: int):
+        self.results = deque(maxlen=window)  # (ok, latency, учитывать в задержке)
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probing = False
+
+    def error_rate(self) -> float:
+        if not self.results:
+            return 0.0
+        return sum(1 for ok, _, _ in self.results if not ok) / len(self.results)
+
+    def avg_latency(self) -> float:
+        """Средняя задержка ответов и таймаутов (быстрые ошибки не учитываются)"""
+        latencies = [latency for _, latency, timed in self.results if timed]
+        return sum(latencies) / len(latencies) if latencies else 0.0
+
+
+class ModelHealth:
+    """Статистика и состояние выключателя по моделям"""
+
+    def __init__(
+        self,
+        window: int = AI_HEALTH_WINDOW,
+        min_samples: int = AI_BREAKER_MIN_SAMPLES,
+        error_rate: float = AI_BREAKER_ERROR_RATE,
+        cooldown: float = AI_BREAKER_COOLDOWN
+    ):
+        self.window = window
+        self.min_samples = min_samples
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self._models: Dict[str, _ModelState] = {}
+
+    def _get(self, model: str) -> _ModelState:
+        state = self._models.get(model)
+        if state is None:
+            state = _ModelState(self.window)
+            self._models[model] = state
+        return state
+
+    def available(self, model: str) -> bool:
+        """Можно ли сейчас вызвать модель (без изменения состояния)"""
+        state = self._get(model)
+        if state.state == CLOSED:
+            return True
+        if state.probing:
+            return False
+        return time.monotonic() - state.opened_at >= self.cooldown
+
+    def begin(self, model: str) -> bool:
+        """
+        Перед вызовом модели. Для разомкнутой цепи после паузы - переход
+        в half-open и разрешение единственного пробного запроса.
+        """
+        if not self.available(model):
+            return False
+        state = self._get(model)
+        if state.state != CLOSED:
+            state.state = HALF_OPEN
+            state.probing = True
+        return True
+
+    def record_success(self, model: str, latency: float):
+        state = self._get(model)
+        if state.state != CLOSED:
+            logger.info(f"Model {model} recovered, circuit closed")
+            state.state = CLOSED
+            state.results.clear()
+        state.probing = False
+        state.results.append((True, latency, True))
+
+    def record_failure(self, model: str, latency: float, timeout: bool = False):
+        """Ошибка модели; timeout=True - ответа не дождались, latency - время ожидания"""
+        state = self._get(model)
+        state.probing = False
+        state.results.append((False, latency, timeout))
+        if state.state == HALF_OPEN or (
+            state.state == CLOSED
+            and len(state.results) >= self.min_samples
+            and state.error_rate() >= self.error_rate
+        ):
+            if state.state == CLOSED:
+                logger.warning(f"Model {model} error rate {state.error_rate():.0%}, circuit opened")
+            state.state = OPEN
+            state.opened_at = time.monotonic()
+
+    def cancel(self, model: str, elapsed: float):
+        """
+        Запрос отменён, ответа не было (например, проиграл в хеджировании):
+        считается таймаутом, если модель ждали хотя бы AI_HEALTH_CANCEL_MIN_SECONDS
+        """
+        if elapsed >= AI_HEALTH_CANCEL_MIN_SECONDS:
+            self.record_failure(model, elapsed, timeout=True)
+        else:
+            self._get(model).probing = False
+
+    def order(self, models: List[str]) -> List[str]:
+        """
+        Доступные модели - по доле ошибок и задержке (при равенстве -
+        в заданном порядке), затем разомкнутые. Модели без статистики
+        считаются здоровыми и быстрыми.
+        """
+        def key(item):
+            index, model = item
+            state = self._get(model)
+            return (
+                not self.available(model),
+                round(state.error_rate(), 1),
+                int(state.avg_latency() / AI_HEALTH_LATENCY_BUCKET),
+                index
+            )
+
+        return [model for _, model in sorted(enumerate(models), key=key)]
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        result = {}
+        for model, state in self._models.items():
+            result[model] = {
+                "state": state.state,
+                "samples": len(state.results),
+                "error_rate": round(state.error_rate(), 3),
+                "avg_latency_ms": round(state.avg_latency() * 1000, 1),
+                "open_for_s": round(now - state.opened_at, 1) if state.state != CLOSED else 0.0
+            }
+        return result
+
+
+# Глобальный экземпляр
+model_health = ModelHealth()
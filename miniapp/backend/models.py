@@ -5,6 +5,7 @@ Pydantic модели для валидации данных
 from pydantic import BaseModel, Field, validator
 from typing import Optional, List
 from datetime import datetime
+from zoneinfo import ZoneInfo
 
 # ==================== USER MODELS ====================
 
@@ -18,6 +19,19 @@ class UserProfile(BaseModel):
     labs_credits: int = 0
     achievements_count: int = 0
     active_challenges: int = 0
+    timezone: str = "UTC"
+
+class TimezoneUpdate(BaseModel):
+    """Смена часового пояса пользователя"""
+    timezone: str = Field(..., min_length=1, max_length=64)
+    
+    @validator('timezone')
+    def validate_timezone(cls, v):
+        try:
+            ZoneInfo(v)
+        except Exception:
+            raise ValueError("Unknown timezone")
+        return v
 
 # ==================== MEAL MODELS ====================
 
@@ -44,7 +58,21 @@ class MealResponse(BaseModel):
     fats: float
     carbs: float
     summary: str
-    source: str  # "database" или "ai"
+    source: str  # "database", "cache" или "ai"
+
+class MealImportRow(BaseModel):
+    """Результат импорта одной строки файла"""
+    row: int
+    status: str  # "ok" или "error"
+    calories: Optional[int] = None
+    source: Optional[str] = None  # "file" или "database"
+    error: Optional[str] = None
+
+class MealImportResult(BaseModel):
+    """Результат массового импорта"""
+    imported: int
+    failed: int
+    rows: List[MealImportRow]
 
 # ==================== DIARY MODELS ====================
 
@@ -57,6 +85,11 @@ class DiaryDay(BaseModel):
     total_carbs: float
     meals: List[dict]
 
+class MealHistoryPage(BaseModel):
+    """Страница истории приёмов пищи"""
+    meals: List[dict]
+    next_cursor: Optional[str] = None  # None - больше записей нет
+
 class DiaryPeriod(BaseModel):
     """Дневник за период"""
     days: List[DiaryDay]
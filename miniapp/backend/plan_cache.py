@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Кэш сгенерированных планов питания в PostgreSQL (таблица plan_cache).
+Ключ - sha256 от нормализованных параметров запроса и рассчитанной
+калорийности: одинаковые анкеты получают готовый план без обращения к AI.
+"""
+import os
+import json
+import hashlib
+import logging
+from typing import Optional
+
+logger = logging.getLogger("plan_cache")
+
+PLAN_CACHE_TTL = int(os.getenv("PLAN_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+
+def _normalize(text: Optional[str]) -> str:
+    text = (text or "").lower().replace("ё", "е")
+    return " ".join(text.split())
+
+
+def plan_cache_key(plan_request, daily_calories: int) -> str:
+    """Ключ кэша: не зависит от регистра и лишних пробелов в текстовых полях"""
+    fields = {
+        "age": plan_request.age,
+        "sex": plan_request.sex,
+        "weight": round(plan_request.weight, 1),
+        "height": round(plan_request.height, 1),
+        "activity": _normalize(plan_request.activity),
+        "goal": _normalize(plan_request.goal),
+        "preferences": _normalize(plan_request.preferences),
+        "restrictions": _normalize(plan_request.restrictions),
+        "daily_calories": daily_calories
+    }
+    raw = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class PlanCache:
+    """request_key → текст плана (с TTL)"""
+
+    def __init__(self, ttl: int = PLAN_CACHE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    async def get(self, key: str) -> Optional[str]:
+        from database_async import execute_query_async
+
+        try:
+            rows = await execute_query_async(
+                """
+                SELECT plan FROM plan_cache
+                WHERE request_key = %s AND created_at > now() - make_interval(secs => %s)
+                """,
+                (key, self.ttl)
+            )
+        except Exception as e:
+            logger.warning(f"Plan cache DB read failed: {e}")
+            rows = []
+
+        if rows:
+            self.hits += 1
+            return rows[0]["plan"]
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, daily_calories: int, plan: str):
+        from database_async import execute_update_async
+
+        try:
+            await execute_update_async(
+                """
+                INSERT INTO plan_cache (request_key, daily_calories, plan, created_at)
+                VALUES (%s, %s, %s, now())
+                ON CONFLICT (request_key) DO UPDATE SET
+                    plan = EXCLUDED.plan,
+                    created_at = EXCLUDED.created_at
+                """,
+                (key, daily_calories, plan)
+            )
+        except Exception as e:
+            logger.warning(f"Plan cache DB write failed: {e}")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+
+# Глобальный экземпляр
+plan_cache = PlanCache()
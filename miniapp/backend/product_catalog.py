@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Справочник продуктов в памяти процесса.
+Загружается из таблицы products один раз и периодически обновляется,
+поэтому оценка еды по базе не делает запросов к БД.
+"""
+import os
+import re
+import asyncio
+import bisect
+import difflib
+import logging
+from typing import Optional, Dict, List
+from datetime import datetime, timezone
+
+logger = logging.getLogger("product_catalog")
+
+PRODUCTS_REFRESH_SECONDS = int(os.getenv("PRODUCTS_REFRESH_SECONDS", "600"))
+PRODUCTS_FUZZY_CUTOFF = float(os.getenv("PRODUCTS_FUZZY_CUTOFF", "0.8"))
+
+
+def normalize_name(name: str) -> str:
+    """Нормализация названия: регистр, ё→е, лишние пробелы и знаки"""
+    name = (name or "").lower().replace("ё", "е")
+    name = re.sub(r"[^\w\s%.]", " ", name)
+    return " ".join(name.split())
+
+
+def _token_key(normalized: str) -> str:
+    """Ключ без учёта порядка слов: «грудка куриная» == «куриная грудка»"""
+    return " ".join(sorted(normalized.split()))
+
+
+class ProductCatalog:
+    """
+    Индекс продуктов по нормализованному названию.
+    Поиск: точное совпадение → совпадение без учёта порядка слов →
+    по префиксу → нечёткое (difflib).
+    """
+
+    def __init__(self):
+        self._by_name: Dict[str, dict] = {}
+        self._by_tokens: Dict[str, dict] = {}
+        self._names: List[str] = []
+        self.loaded_at: Optional[datetime] = None
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def load(self, rows: List[dict]):
+        """Построить индекс из строк таблицы products и атомарно подменить текущий"""
+        by_name = {}
+        by_tokens = {}
+        for row in rows:
+            key = normalize_name(row["name"])
+            if not key:
+                continue
+            by_name[key] = row
+            by_tokens.setdefault(_token_key(key), row)
+
+        self._by_name, self._by_tokens, self._names = by_name, by_tokens, sorted(by_name)
+        self.loaded_at = datetime.now(timezone.utc)
+
+    async def refresh(self):
+        """Перечитать справочник из БД"""
+        from database_async import execute_query_async
+
+        rows = await execute_query_async(
+            "SELECT name, kcal_per_100, proteins_per_100, fats_per_100, carbs_per_100 FROM products"
+        )
+        self.load(rows)
+        logger.info(f"Product catalog loaded: {len(self)} products")
+
+    def lookup(self, name: str) -> Optional[dict]:
+        """Найти продукт по названию, без обращения к БД"""
+        key = normalize_name(name)
+        if not key:
+            return None
+
+        product = self._by_name.get(key) or self._by_tokens.get(_token_key(key))
+        if product:
+            return product
+
+        # По префиксу: «куриная» → «куриная грудка»
+        i = bisect.bisect_left(self._names, key)
+        if i < len(self._names) and self._names[i].startswith(key):
+            return self._by_name[self._names[i]]
+
+        # Нечёткое совпадение: «бананы» → «банан»
+        match = difflib.get_close_matches(key, self._names, n=1, cutoff=PRODUCTS_FUZZY_CUTOFF)
+        if match:
+            return self._by_name[match[0]]
+        match = difflib.get_close_matches(_token_key(key), list(self._by_tokens), n=1, cutoff=PRODUCTS_FUZZY_CUTOFF)
+        if match:
+            return self._by_tokens[match[0]]
+
+        return None
+
+    async def run_refresh_loop(self, interval: int = PRODUCTS_REFRESH_SECONDS):
+        """Фоновое периодическое обновление (запускается из lifespan)"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning(f"Product catalog refresh failed: {e}")
+
+
+# Глобальный экземпляр
+catalog = ProductCatalog()
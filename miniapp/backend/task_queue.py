@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Ограниченная очередь фоновых задач (работа после ответа пользователю).
+
+- фиксированное число воркеров и ограниченная длина очереди;
+- одинаковые задачи (по ключу) схлопываются, пока ждут в очереди;
+- синхронные функции выполняются в отдельном пуле потоков, корутины - в event loop;
+- при остановке очередь дорабатывается с таймаутом.
+"""
+import os
+import time
+import asyncio
+import inspect
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Hashable, Optional
+
+logger = logging.getLogger("task_queue")
+
+TASK_QUEUE_WORKERS = int(os.getenv("TASK_QUEUE_WORKERS", "4"))
+TASK_QUEUE_MAX_SIZE = int(os.getenv("TASK_QUEUE_MAX_SIZE", "1000"))
+TASK_QUEUE_THREADS = int(os.getenv("TASK_QUEUE_THREADS", "4"))
+TASK_QUEUE_SHUTDOWN_TIMEOUT = float(os.getenv("TASK_QUEUE_SHUTDOWN_TIMEOUT", "10"))
+
+
+class BackgroundQueue:
+    """Очередь задач с пулом воркеров и метриками"""
+
+    def __init__(
+        self,
+        workers: int = TASK_QUEUE_WORKERS,
+        max_size: int = TASK_QUEUE_MAX_SIZE,
+        threads: int = TASK_QUEUE_THREADS
+    ):
+        self.workers = workers
+        self.max_size = max_size
+        self.threads = threads
+        self._queue: Optional[asyncio.Queue] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._tasks = []
+        self._pending = set()
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.coalesced = 0
+        self._wait_total = 0.0
+        self._run_total = 0.0
+        self.max_wait = 0.0
+
+    async def start(self):
+        """Запустить воркеры (из lifespan)"""
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="bg-job")
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"Background queue started (workers={self.workers}, max_size={self.max_size})")
+
+    def submit(self, key: Hashable, fn: Callable[..., Any], *args) -> bool:
+        """
+        Поставить задачу в очередь.
+        Если задача с таким ключом уже ждёт - новая не добавляется.
+        Возвращает False, если очередь переполнена или не запущена.
+        """
+        if self._queue is None:
+            self.rejected += 1
+            logger.warning(f"Background queue is not running, job {key!r} dropped")
+            return False
+        if key in self._pending:
+            self.coalesced += 1
+            return True
+        try:
+            self._queue.put_nowait((key, fn, args, time.monotonic()))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            logger.warning(f"Background queue is full, job {key!r} dropped")
+            return False
+        self._pending.add(key)
+        return True
+
+    async def _worker(self, n: int):
+        loop = asyncio.get_running_loop()
+        while True:
+            key, fn, args, enqueued = await self._queue.get()
+            # Снимаем ключ до запуска: события во время выполнения попадут в новую задачу
+            self._pending.discard(key)
+            started = time.monotonic()
+            wait = started - enqueued
+            self._wait_total += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.in_flight += 1
+            try:
+                if inspect.iscoroutinefunction(fn):
+                    await fn(*args)
+                else:
+                    await loop.run_in_executor(self._executor, fn, *args)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                logger.exception(f"Background job {key!r} failed")
+            finally:
+                self.in_flight -= 1
+                self._run_total += time.monotonic() - started
+                self._queue.task_done()
+
+    async def stop(self, timeout: float = TASK_QUEUE_SHUTDOWN_TIMEOUT):
+        """Дождаться выполнения очереди (не дольше timeout) и остановить воркеры"""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Background queue: {self._queue.qsize()} jobs left unprocessed on shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._executor.shutdown(wait=True)
+        self._queue = None
+        self._tasks = []
+        logger.info("Background queue stopped")
+
+    def stats(self) -> dict:
+        """Глубина очереди и задержки"""
+        finished = self.processed + self.failed
+        return {
+            "depth": self._queue.qsize() if self._queue is not None else 0,
+            "in_flight": self.in_flight,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "coalesced": self.coalesced,
+            "avg_wait_ms": round(self._wait_total / finished * 1000, 1) if finished else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "avg_run_ms": round(self._run_total / finished * 1000, 1) if finished else 0.0
+        }
+
+
+# Глобальный экземпляр
+background_queue = BackgroundQueue()
@@ -128,7 +128,15 @@ async function loadProfile() {
         const badge = document.getElementById('sub-badge');
         badge.textContent = getSubscriptionText(userProfile.subscription_status);
         badge.className = `subscription-badge ${userProfile.subscription_status}`;
-        
+
+        // Синхронизируем часовой пояс (границы дня в дневнике)
+        const timezone = Intl.DateTimeFormat().resolvedOptions().timeZone;
+        if (timezone && userProfile.timezone !== timezone) {
+            apiPost('/user/timezone', { timezone })
+                .then(() => { userProfile.timezone = timezone; })
+                .catch(() => {});
+        }
+
         return userProfile;
     } catch (error) {
         console.error('Failed to load profile:', error);
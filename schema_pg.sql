@@ -9,9 +9,12 @@ CREATE TABLE IF NOT EXISTS subscriptions (
     expires_at TIMESTAMP WITH TIME ZONE,
     free_until TIMESTAMP WITH TIME ZONE,
     used_free_lab BOOLEAN DEFAULT FALSE,
+    tz TEXT NOT NULL DEFAULT 'UTC',  -- часовой пояс пользователя (IANA)
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
+ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS tz TEXT NOT NULL DEFAULT 'UTC';
+
 CREATE INDEX IF NOT EXISTS idx_subscriptions_expires ON subscriptions(expires_at);
 CREATE INDEX IF NOT EXISTS idx_subscriptions_free ON subscriptions(free_until);
 
@@ -74,6 +77,7 @@ CREATE TABLE IF NOT EXISTS meals (
     id SERIAL PRIMARY KEY,
     user_id BIGINT NOT NULL,
     ts TIMESTAMP WITH TIME ZONE NOT NULL,
+    local_day DATE,  -- день в часовом поясе пользователя на момент записи
     text TEXT,
     calories INTEGER,
     proteins REAL,
@@ -84,6 +88,13 @@ CREATE TABLE IF NOT EXISTS meals (
 
 CREATE INDEX IF NOT EXISTS idx_meals_user_ts ON meals(user_id, ts DESC);
 
+ALTER TABLE meals ADD COLUMN IF NOT EXISTS local_day DATE;
+UPDATE meals m SET local_day = (m.ts AT TIME ZONE s.tz)::date
+FROM subscriptions s
+WHERE s.user_id = m.user_id AND m.local_day IS NULL;
+
+CREATE INDEX IF NOT EXISTS idx_meals_user_local_day ON meals(user_id, local_day);
+
 -- Продукты (база данных питания)
 CREATE TABLE IF NOT EXISTS products (
     name TEXT PRIMARY KEY,
@@ -136,6 +147,103 @@ CREATE TABLE IF NOT EXISTS challenge_logs (
     FOREIGN KEY (user_id, challenge_type) REFERENCES challenges(user_id, challenge_type) ON DELETE CASCADE
 );
 
+-- Дневные итоги питания (поддерживаются при вставке/удалении в meals,
+-- заполнение для существующих данных: python backfill_daily_totals.py)
+CREATE TABLE IF NOT EXISTS meal_daily_totals (
+    user_id BIGINT NOT NULL,
+    local_date DATE NOT NULL,
+    meal_count INTEGER NOT NULL DEFAULT 0,
+    calories BIGINT NOT NULL DEFAULT 0,
+    proteins DOUBLE PRECISION NOT NULL DEFAULT 0,
+    fats DOUBLE PRECISION NOT NULL DEFAULT 0,
+    carbs DOUBLE PRECISION NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, local_date),
+    FOREIGN KEY (user_id) REFERENCES subscriptions(user_id) ON DELETE CASCADE
+);
+
+-- Кэш AI-оценок приёмов пищи (ключ - нормализованный текст)
+CREATE TABLE IF NOT EXISTS meal_estimate_cache (
+    text_key TEXT PRIMARY KEY,
+    calories INTEGER NOT NULL,
+    proteins REAL NOT NULL,
+    fats REAL NOT NULL,
+    carbs REAL NOT NULL,
+    summary TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Кэш сгенерированных планов питания (ключ - sha256 от нормализованного запроса и калорийности)
+CREATE TABLE IF NOT EXISTS plan_cache (
+    request_key TEXT PRIMARY KEY,
+    daily_calories INTEGER NOT NULL,
+    plan TEXT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Счётчики профиля (поддерживаются триггерами при записи)
+CREATE TABLE IF NOT EXISTS user_counters (
+    user_id BIGINT PRIMARY KEY,
+    achievements_count INTEGER NOT NULL DEFAULT 0,
+    active_challenges INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY (user_id) REFERENCES subscriptions(user_id) ON DELETE CASCADE
+);
+
+CREATE OR REPLACE FUNCTION user_counters_achievements() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO user_counters (user_id, achievements_count)
+        VALUES (NEW.user_id, 1)
+        ON CONFLICT (user_id) DO UPDATE
+            SET achievements_count = user_counters.achievements_count + 1;
+        RETURN NEW;
+    END IF;
+    UPDATE user_counters SET achievements_count = GREATEST(achievements_count - 1, 0)
+    WHERE user_id = OLD.user_id;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_achievements_counters ON achievements;
+CREATE TRIGGER trg_achievements_counters
+    AFTER INSERT OR DELETE ON achievements
+    FOR EACH ROW EXECUTE FUNCTION user_counters_achievements();
+
+CREATE OR REPLACE FUNCTION user_counters_challenges() RETURNS TRIGGER AS $$
+DECLARE
+    delta INTEGER := 0;
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.completed = 0 THEN
+        delta := delta + 1;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.completed = 0 THEN
+        delta := delta - 1;
+    END IF;
+    IF delta > 0 THEN
+        INSERT INTO user_counters (user_id, active_challenges)
+        VALUES (NEW.user_id, delta)
+        ON CONFLICT (user_id) DO UPDATE
+            SET active_challenges = user_counters.active_challenges + delta;
+    ELSIF delta < 0 THEN
+        UPDATE user_counters SET active_challenges = GREATEST(active_challenges + delta, 0)
+        WHERE user_id = OLD.user_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_challenges_counters ON challenges;
+CREATE TRIGGER trg_challenges_counters
+    AFTER INSERT OR UPDATE OF completed OR DELETE ON challenges
+    FOR EACH ROW EXECUTE FUNCTION user_counters_challenges();
+
+-- Заполнение счётчиков для существующих пользователей
+INSERT INTO user_counters (user_id, achievements_count, active_challenges)
+SELECT s.user_id,
+       (SELECT COUNT(*) FROM achievements a WHERE a.user_id = s.user_id),
+       (SELECT COUNT(*) FROM challenges c WHERE c.user_id = s.user_id AND c.completed = 0)
+FROM subscriptions s
+ON CONFLICT (user_id) DO NOTHING;
+
 -- Инициализация базовых продуктов
 INSERT INTO products (name, kcal_per_100, proteins_per_100, fats_per_100, carbs_per_100) VALUES
     ('яблоко', 52, 0.3, 0.2, 14),